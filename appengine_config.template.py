@@ -28,6 +28,13 @@
 # tailbone_CORS = True
 # tailbone_CORS_RESTRICTED_DOMAINS = ["http://localhost"]
 
+## Levels of referenced objects expanded in place of their keys when a request passes recurse=true
+# tailbone_RECURSE_DEPTH = 2
+
+## Seconds between checks for a new version of validation.json or searchable.json stored through
+## /api/admin/config/{name}
+# tailbone_CONFIG_CHECK_INTERVAL = 10
+
 ## modify the below functions to change how users are identified
 # tailbone_is_current_user_admin =
 # tailbone_get_current_user =
@@ -191,9 +198,53 @@
 ## Use cloud store instead of blobstore
 # tailboneFiles_CLOUDSTORE = False
 
+## Pull queue and batching for searchable.json models with "_mode": "async"
+# tailboneSearch_QUEUE = "tailbone-search"
+# tailboneSearch_FLUSH_DELAY = 5
+# tailboneSearch_BATCH_SIZE = 200
+
 ## Store counts for restful models accessible in HEAD query
 # tailboneRestful_METADATA = False
 
+## Buffer counter changes in memcache and write them to the shards every FLUSH_DELAY seconds
+# tailboneCounter_BUFFERED = True
+# tailboneCounter_FLUSH_DELAY = 10
+# tailboneCounter_CONFIG_TTL = 60
+# tailboneCounter_COUNT_TTL = 60
+
+## Double the shards of counters whose transactions retry too often, halve the shards of cold ones
+# tailboneCounter_STATS_WINDOW = 300
+# tailboneCounter_CONTENTION_THRESHOLD = 0.05
+# tailboneCounter_COLD_WRITES = 10
+# tailboneCounter_MIN_SHARDS = 1
+# tailboneCounter_MAX_SHARDS = 200
+
+## Normalize query filters and orders, and record the composite indexes queries need
+# tailboneRestful_QUERY_PLANNER = True
+# tailboneRestful_MAX_SUBQUERIES = 30
+# tailboneRestful_PARALLEL_OR = True
+
+## Bytes of an ndjson upload per POST /api/{modelname}/_import task and objects per put_multi
+# tailboneRestful_IMPORT_CHUNK_BYTES = 1 << 20
+# tailboneRestful_IMPORT_PUT_SIZE = 500
+# tailboneRestful_IMPORT_QUEUE = "default"
+
+## Objects and seconds per GET /api/{modelname}/_export request
+# tailboneRestful_EXPORT_LIMIT = 10000
+# tailboneRestful_EXPORT_SECONDS = 50
+
+## Maintained counts per property value, with the sum, min and max of a numeric property
+# tailboneRestful_AGGREGATES = {"todos": [{"group": "Status"}, {"group": "owners", "value": "Points"}]}
+
+## Cache GET by id results in memcache, seconds to live globally and per model name
+# tailboneRestful_CACHE = True
+# tailboneRestful_CACHE_TTL = 60
+# tailboneRestful_CACHE_TTLS = {"todos": 300}
+
+## Cache query pages in memcache, a write to a model invalidates all of its cached queries
+# tailboneRestful_QUERY_CACHE = True
+# tailboneRestful_QUERY_CACHE_TTL = 30
+
 ## If specified is a list of tailbone.restful.ScopedModel objects these will be the only ones allowed.
 ## This is a next level step of model restriction to your db, this replaces validation.json
 # from google.appengine.ext import ndb
@@ -221,6 +272,12 @@
 ## Seconds until room expires
 # tailboneMesh_ROOM_EXPIRATION = 86400
 
+## Spread busy rooms over several websocket instances that relay to each other
+# tailboneMesh_FEDERATE = True
+# tailboneMesh_FEDERATE_LOAD = 0.5
+# tailboneMesh_RELAY_PORT = 8890
+# tailboneMesh_SECRET = "a-long-random-string"
+
 ## Protected site
 # tailboneStaticProtected_PASSWORD = "mypassword"
 ## the base path for the protected site can change to deploy or something else defaults to app
@@ -14,11 +14,15 @@
 
 import cgi
 import functools
+import importlib
+import itertools
 import json
 import logging
 import os
 import re
 import sys
+import time
+import types
 try:
   import traceback
 except:
@@ -27,6 +31,9 @@ import webapp2
 import yaml
 
 from google.appengine import api
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 sys.path.insert(0, "tailbone/dependencies.zip")
@@ -47,6 +54,10 @@ class _ConfigDefaults(object):
   CORS = False
   CORS_RESTRICTED_DOMAINS = None
   CONFIG = {}
+  # levels of referenced objects expanded in place of their keys when a request has recurse=true
+  RECURSE_DEPTH = 2
+  # seconds an instance keeps a reloadable config before checking its generation again
+  CONFIG_CHECK_INTERVAL = 10
 
   def is_current_user_admin(*args, **kwargs):
     return api.users.is_current_user_admin(*args, **kwargs)
@@ -94,19 +105,81 @@ def json_extras(obj):
   if isinstance(obj, ndb.GeoPt):
     return {"lat": obj.lat, "lon": obj.lon}
   if isinstance(obj, ndb.Key):
-    r = webapp2.get_request()
-    if r.get("recurse", default_value=False):
-      item = obj.get()
-      if item == None:
-        return obj.urlsafe()
-      item = item.to_dict()
-      item["$class"] = obj.kind()
-      return item
     return obj.urlsafe()
   return None
 
 
+# Replace the keys in a response with the objects they reference, as requested by recurse=true.
+# All keys of one level are read with a single get_multi before the next level is collected. The
+# memo maps keys to their serialized objects so every key is read at most once per request, and
+# cycles stop at RECURSE_DEPTH. Only kinds with a registered model class are expanded.
+def expand_keys(resp, memo=None, depth=None):
+  memo = {} if memo is None else memo
+  depth = config.RECURSE_DEPTH if depth is None else depth
+  level = _collect_keys(resp, set())
+  for _ in range(depth):
+    missing = [k for k in level if k not in memo and k.kind() in ndb.Model._kind_map]
+    if not missing:
+      break
+    level = set()
+    for key, item in zip(missing, ndb.get_multi(missing)):
+      if item is not None:
+        item = item.to_dict()
+        item["$class"] = key.kind()
+        _collect_keys(item, level)
+      memo[key] = item
+  return _substitute_keys(resp, memo, depth)
+
+
+# Expand the keys of a streamed list in chunks so each level is still one get_multi per chunk.
+def expand_keys_stream(items, chunk_size=100):
+  memo = {}
+  chunk = list(itertools.islice(items, chunk_size))
+  while chunk:
+    for item in expand_keys(chunk, memo):
+      yield item
+    chunk = list(itertools.islice(items, chunk_size))
+
+
+def _collect_keys(obj, keys):
+  if isinstance(obj, ndb.Key):
+    keys.add(obj)
+  elif isinstance(obj, dict):
+    for v in obj.itervalues():
+      _collect_keys(v, keys)
+  elif isinstance(obj, (list, tuple)):
+    for v in obj:
+      _collect_keys(v, keys)
+  return keys
+
+
+def _substitute_keys(obj, memo, depth):
+  if isinstance(obj, ndb.Key):
+    item = memo.get(obj)
+    if item is None or depth <= 0:
+      return obj
+    return _substitute_keys(item, memo, depth - 1)
+  if isinstance(obj, dict):
+    return dict((k, _substitute_keys(v, memo, depth)) for k, v in obj.iteritems())
+  if isinstance(obj, (list, tuple)):
+    return [_substitute_keys(v, memo, depth) for v in obj]
+  return obj
+
+
+# Write a generator of items as a json list, encoding one item at a time so the whole list and its
+# encoded string never have to be held in memory together.
+def write_json_list(out, items):
+  out.write("[")
+  separator = ""
+  for item in items:
+    out.write(separator)
+    out.write(json.dumps(item, default=json_extras))
+    separator = ","
+  out.write("]")
+
+
 # Decorator to return the result of a function as json. It supports jsonp by default.
+# Functions may return a generator to have their list result streamed to the response.
 def as_json(func):
   """Returns json when callback in url"""
   @functools.wraps(func)
@@ -116,13 +189,29 @@ def as_json(func):
       self.response.headers["Access-Control-Allow-Origin"] = "*"
       self.response.headers["Access-Control-Allow-Methods"] = "POST,GET,PUT,PATCH,HEAD,OPTIONS"
       self.response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    callback = self.request.get("callback") if config.JSONP else None
     try:
       resp = func(self, *args, **kwargs)
       if resp is None:
         resp = {}
+      if self.request.get("recurse", default_value=False):
+        if isinstance(resp, types.GeneratorType):
+          resp = expand_keys_stream(resp)
+        else:
+          resp = expand_keys(resp)
+      if isinstance(resp, types.GeneratorType):
+        if callback:
+          self.response.out.write("{}(".format(callback))
+        write_json_list(self.response.out, resp)
+        if callback:
+          self.response.out.write(");")
+        resp = None
     except BreakError as e:
+      # the handler wrote its own response, it still needs the cors headers
+      set_cors_headers(self)
       return
     except LoginError as e:
+      self.response.clear()
       self.response.set_status(401)
       url = api.users.create_login_url(self.request.url)
       resp = {
@@ -132,25 +221,32 @@ def as_json(func):
       }
     except (AppError, api.datastore_errors.BadArgumentError,
             api.datastore_errors.BadRequestError) as e:
+      # anything already streamed is discarded, the response is buffered until the handler returns
+      self.response.clear()
       self.response.set_status(400)
       resp = {"error": e.__class__.__name__, "message": e.message}
+    if callback:
+      self.response.headers["Content-Type"] = "text/javascript"
+    set_cors_headers(self)
+    if resp is None:
+      return
     if not isinstance(resp, str) and not isinstance(resp, unicode):
       resp = json.dumps(resp, default=json_extras)
-    if config.JSONP:
-      callback = self.request.get("callback")
-      if callback:
-        self.response.headers["Content-Type"] = "text/javascript"
-        resp = "%s(%s);".format(callback, resp)
-    if config.CORS:
-      origin = self.request.headers.get("Origin")
-      if not config.CORS_RESTRICTED_DOMAINS:
-        self.response.headers["Access-Control-Allow-Origin"] =  "*"
-      elif origin in config.CORS_RESTRICTED_DOMAINS:
-        self.response.headers["Access-Control-Allow-Origin"] = origin
+    if callback:
+      resp = "{}({});".format(callback, resp)
     self.response.out.write(resp)
   return wrapper
 
 
+def set_cors_headers(handler):
+  if config.CORS:
+    origin = handler.request.headers.get("Origin")
+    if not config.CORS_RESTRICTED_DOMAINS:
+      handler.response.headers["Access-Control-Allow-Origin"] =  "*"
+    elif origin in config.CORS_RESTRICTED_DOMAINS:
+      handler.response.headers["Access-Control-Allow-Origin"] = origin
+
+
 # BaseHandler for error handling
 class BaseHandler(webapp2.RequestHandler):
   def handle_exception(self, exception, debug):
@@ -201,6 +297,120 @@ def parse_body(self):
   return data or {}
 
 
+# Windowed tasks
+# --------------
+# Flushes and resizes run at most once per window. The task name carries the window so the
+# taskqueue drops duplicates, and each process remembers the windows it already scheduled so it
+# does not pay a taskqueue call that can only fail with TaskAlreadyExistsError.
+_scheduled_windows = {}
+
+def defer_once(name, period, func, *args, **kwargs):
+  """Defer func at most once per window of period seconds for a task name prefix."""
+  window = int(time.time() / max(period, 1))
+  if _scheduled_windows.get(name) == window:
+    return
+  task_name = "{}-{}".format(re.sub(r"[^a-zA-Z0-9_-]", "-", name), window)
+  try:
+    deferred.defer(func, *args, _name=task_name, **kwargs)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+  _scheduled_windows[name] = window
+
+
+# Reloadable json configs
+# -----------------------
+# validation.json and searchable.json can be replaced at runtime by storing a new version through
+# /api/admin/config/{name}. Every instance checks the generation of the stored version in memcache
+# at most once per CONFIG_CHECK_INTERVAL seconds and only reads the document when it changed.
+# config names and the modules that compile them
+RELOADABLE_CONFIGS = {
+  "validation.json": "tailbone.restful",
+  "searchable.json": "tailbone.search",
+}
+_reloadable = {}
+CONFIG_GENERATION_TEMPLATE = "tailbone-config-generation-{}"
+
+
+class TailboneConfigDocument(ndb.Model):
+  """A stored version of a reloadable json config, keyed by file name."""
+  content = ndb.TextProperty()
+  generation = ndb.IntegerProperty(default=0, indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class ReloadableConfig(object):
+  """A compiled json config that starts from its file and follows the stored versions."""
+
+  def __init__(self, name, compile, missing_message):
+    _reloadable[name] = self
+    self.name = name
+    self.compile = compile
+    self.generation = 0
+    self.value = None
+    try:
+      with open(name) as f:
+        self.value = compile(json.load(f))
+    except ValueError:
+      logging.error("{} is not a valid json document.".format(name))
+    except IOError:
+      logging.info(missing_message)
+    self.file_value = self.value
+    # pick up a stored version right away rather than after the first interval
+    self.checked = 0
+
+  def get(self):
+    now = time.time()
+    if now - self.checked < config.CONFIG_CHECK_INTERVAL:
+      return self.value
+    self.checked = now
+    generation_name = CONFIG_GENERATION_TEMPLATE.format(self.name)
+    generation = memcache.get(generation_name)
+    doc = None
+    if generation is None:
+      doc = TailboneConfigDocument.get_by_id(self.name)
+      generation = doc.generation if doc else 0
+      memcache.add(generation_name, generation)
+    if generation != self.generation:
+      doc = doc or TailboneConfigDocument.get_by_id(self.name)
+      self.generation = generation
+      if doc is None:
+        self.value = self.file_value
+      else:
+        try:
+          self.value = self.compile(json.loads(doc.content))
+          logging.info("Loaded generation {} of {}.".format(generation, self.name))
+        except (ValueError, re.error):
+          logging.error("Stored {} generation {} is invalid, keeping the previous one.".format(
+              self.name, generation))
+    return self.value
+
+
+@ndb.transactional
+def _store_config(name, content):
+  doc = TailboneConfigDocument.get_by_id(name) or TailboneConfigDocument(id=name)
+  doc.content = content
+  doc.generation += 1
+  doc.put()
+  return doc.generation
+
+
+def store_config(name, data):
+  """Store a new version of a reloadable config and return its generation."""
+  if name not in RELOADABLE_CONFIGS:
+    raise AppError("{} is not a reloadable config.".format(name))
+  if not isinstance(data, dict):
+    raise AppError("{} must be a json object.".format(name))
+  # compile it here so a bad version is refused instead of ignored by every instance
+  importlib.import_module(RELOADABLE_CONFIGS[name])
+  try:
+    _reloadable[name].compile(data)
+  except (ValueError, re.error) as e:
+    raise AppError("{} is invalid: {}".format(name, e))
+  generation = _store_config(name, json.dumps(data))
+  memcache.set(CONFIG_GENERATION_TEMPLATE.format(name), generation)
+  return generation
+
+
 def build_service(service_name, api_version, scopes):
   """Get an authorized service account http connection"""
   if DEBUG:
@@ -22,6 +22,24 @@ def notFound(self):
   self.error(404)
   return {"error": "Not Found"}
 
+# Read or replace the stored version of a reloadable config such as validation.json, instances pick
+# up a new version within CONFIG_CHECK_INTERVAL seconds.
+class AdminConfigHandler(BaseHandler):
+  @as_json
+  def get(self, name):
+    if name not in RELOADABLE_CONFIGS:
+      raise AppError("{} is not a reloadable config.".format(name))
+    doc = TailboneConfigDocument.get_by_id(name)
+    if doc is None:
+      return {}
+    return {"generation": doc.generation, "config": json.loads(doc.content)}
+
+  @as_json
+  def put(self, name):
+    return {"generation": store_config(name, parse_body(self))}
+
+  post = put
+
 class AdminShortcutHandler(BaseHandler):
   @as_json
   def get(self, action):
@@ -30,5 +48,6 @@ class AdminShortcutHandler(BaseHandler):
     }.get(action, notFound)(self)
 
 app = webapp2.WSGIApplication([
+  (r"{}admin/config/([^/]+)".format(PREFIX), AdminConfigHandler),
   (r"{}admin/(.*)".format(PREFIX), AdminShortcutHandler),
   ], debug=DEBUG)
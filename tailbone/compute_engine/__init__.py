@@ -252,6 +252,7 @@ class InstanceStatus(object):
 class TailboneCEInstance(polymodel.PolyModel):
   load = ndb.FloatProperty(default=0)
   address = ndb.StringProperty()  # address of the service with port number e.g. ws://72.4.2.1:2345/
+  internal_address = ndb.StringProperty()  # address on the project network
   zone = ndb.StringProperty()
   status = ndb.StringProperty(default=InstanceStatus.PENDING)
   pool = ndb.KeyProperty()
@@ -400,6 +401,7 @@ def update_instance_status(urlsafe_key):
   if status == InstanceStatus.RUNNING:
     instance.status = status
     instance.address = info["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
+    instance.internal_address = info["networkInterfaces"][0].get("networkIP")
     instance.put()
     name = "update_instance_status_{}_{}".format(urlsafe_key, int(time.time()))
     deferred.defer(update_instance_status, urlsafe_key, _countdown=STATUS_DELAY, _name=name)
@@ -583,6 +585,7 @@ class LoadBalancer(object):
               instance.zone = info.get("zone").split("/")[-1]
               instance.status = status
               instance.address = info["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
+              instance.internal_address = info["networkInterfaces"][0].get("networkIP")
               instance.pool = pool.key
               instance.put()
               name = "update_instance_status_{}_{}".format(instance.key.urlsafe(), int(time.time()))
@@ -71,6 +71,10 @@ http.POST = function(url, data, load, error, context) {
   xhr = json_request('POST', url, load, error, context);
   xhr.send(JSON.stringify(data));
 };
+http.PATCH = function(url, data, load, error, context) {
+  xhr = json_request('PATCH', url, load, error, context);
+  xhr.send(JSON.stringify(data));
+};
 http.DELETE = function(url, load, error, context) {
   xhr = json_request('DELETE', url, load, error, context);
   xhr.send();
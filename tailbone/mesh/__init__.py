@@ -18,15 +18,22 @@ from tailbone import config
 from tailbone import DEBUG
 from tailbone import PREFIX
 from tailbone import turn
+from tailbone.compute_engine import InstanceStatus
 from tailbone.compute_engine import LoadBalancer
 from tailbone.compute_engine import TailboneCEInstance
 from tailbone.compute_engine import STARTUP_SCRIPT_BASE
+from tailbone.compute_engine import STATUS_DELAY
 
 import base64
+import hashlib
+import hmac
 import json
 import os
+import pipes
 import random
 import string
+import time
+import urllib
 import webapp2
 
 from google.appengine.api import users
@@ -44,6 +51,12 @@ class _ConfigDefaults(object):
   ENABLE_WEBSOCKET = False
   ENABLE_TURN = False
   PORT = 8889
+  # spread a room over several websocket instances linked by the python server's relay
+  FEDERATE = False
+  # projected load past which a room takes in another instance
+  FEDERATE_LOAD = 0.5
+  RELAY_PORT = 8890
+  SECRET = "notasecret"
   SOURCE_SNAPSHOT = None
   PARAMS = {}
 
@@ -53,6 +66,31 @@ class _ConfigDefaults(object):
 
 _config = lib_config.register('tailboneMesh', _ConfigDefaults.__dict__)
 
+if _config.FEDERATE:
+  WEBSOCKET_SCRIPT = """
+# federated websocket server
+apt-get install -y python-pip
+# tornado 5.1 is the last release for python 2, msgpack-python 0.5.2 added unpackb(raw=False)
+pip install 'tornado==5.1.1' 'msgpack-python==0.5.6'
+cat >websocket.py <<'EOL'
+%s
+EOL
+INTERNAL_IP=$(curl -s -H "Metadata-Flavor: Google" http://metadata.google.internal/computeMetadata/v1/instance/network-interfaces/0/ip)
+python websocket.py --port %s --workers 0 --secret %s --relay-port %s --relay-address $INTERNAL_IP
+
+""" % (open("tailbone/mesh/websocket.py").read(), _config.PORT, pipes.quote(_config.SECRET),
+       _config.RELAY_PORT)
+else:
+  WEBSOCKET_SCRIPT = """
+# websocket server
+./nodejs/bin/npm install ws
+cat >websocket.js <<EOL
+%s
+EOL
+./nodejs/bin/node websocket.js %s
+
+""" % (open("tailbone/mesh/websocket.js").read(), _config.PORT)
+
 class TailboneWebsocketInstance(TailboneCEInstance):
   SOURCE_SNAPSHOT = _config.SOURCE_SNAPSHOT
   PARAMS = dict(dict(TailboneCEInstance.PARAMS, **{
@@ -61,15 +99,7 @@ class TailboneWebsocketInstance(TailboneCEInstance):
       "items": [
         {
           "key": "startup-script",
-          "value": STARTUP_SCRIPT_BASE + """
-# websocket server
-./nodejs/bin/npm install ws
-cat >websocket.js <<EOL
-%s
-EOL
-./nodejs/bin/node websocket.js %s
-
-""" % (open("tailbone/mesh/websocket.js").read(), _config.PORT),
+          "value": STARTUP_SCRIPT_BASE + WEBSOCKET_SCRIPT,
         },
       ],
     }
@@ -87,12 +117,65 @@ def unique_name():
     return unique_name()
   return name, room, address
 
+def joins_hash(address):
+  """Joins routed to an instance since its load was last measured."""
+  return "tailbone-mesh-joins-{}-{}".format(address, int(time.time()) // STATUS_DELAY)
+
+def federated_address(name, room):
+  """Address of the least loaded instance hosting a room for a new joiner.
+
+  The room in memcache holds the addresses of its instances. Once all of them
+  are past FEDERATE_LOAD the least loaded spare instance is added. The joiner
+  gets the signed list of internal relay hosts, its own instance first, so the
+  websocket servers link up and the room stays one mesh.
+  """
+  if _config.SECRET == _ConfigDefaults.SECRET:
+    raise AppError('Set tailboneMesh_SECRET before federating rooms.')
+  query = TailboneWebsocketInstance.query(
+    TailboneWebsocketInstance.status == InstanceStatus.RUNNING)
+  instances = dict((i.address, i) for i in query if i.address and i.internal_address)
+  if not instances:
+    raise AppError('Instance not yet ready, try again later.')
+  # the load is only measured every STATUS_DELAY, count the joins since then too
+  joins = memcache.get_multi([joins_hash(a) for a in instances])
+  load = dict((a, i.load + float(joins.get(joins_hash(a), 0)) / i.MAX_CLIENTS)
+              for a, i in instances.iteritems())
+  client = memcache.Client()
+  for _ in xrange(10):
+    current = client.gets(room)
+    hosts = [a for a in current or [] if a in instances]
+    spare = [a for a in instances if a not in hosts]
+    address = min(hosts, key=load.get) if hosts else None
+    if spare and (not address or load[address] >= _config.FEDERATE_LOAD):
+      candidate = min(spare, key=load.get)
+      if not address or load[candidate] < load[address]:
+        address = candidate
+        hosts.append(address)
+    if hosts == current:
+      break
+    if current is None:
+      if client.add(room, hosts, time=_config.ROOM_EXPIRATION):
+        break
+    elif client.cas(room, hosts, time=_config.ROOM_EXPIRATION):
+      break
+  else:
+    raise AppError('Room is busy, try again later.')
+  memcache.incr(joins_hash(address), initial_value=0, time=2 * STATUS_DELAY)
+  relays = ",".join("{}:{}".format(instances[a].internal_address, _config.RELAY_PORT)
+                    for a in [address] + [a for a in hosts if a != address])
+  # the prefix keeps the signature apart from the challenges the relays sign
+  signature = hmac.new(_config.SECRET, "hosts:" + relays, hashlib.sha1).hexdigest()
+  return "ws://{}:{}/{}?{}".format(address, _config.PORT, name,
+                                   urllib.urlencode({"hosts": relays, "sig": signature}))
+
 def get_or_create_room(request, name=None):
   if not name:
     name, room, address = unique_name()
   else:
     room = room_hash(name)
     address = memcache.get(room)
+  if _config.ENABLE_WEBSOCKET and _config.FEDERATE and not DEBUG:
+    return name, federated_address(name, room)
   if not address:
     if _config.ENABLE_WEBSOCKET:
       if DEBUG:
@@ -145,7 +228,7 @@ class MeshHandler(BaseHandler):
       raise AppError("Must provide name.")
 
 EXPORTED_JAVASCRIPT = compile_js([
-  # "tailbone/mesh/js/msgpack.js",
+  "tailbone/mesh/js/msgpack.js",
   "tailbone/mesh/js/EventDispatcher.js",
   "tailbone/mesh/js/StateDrive.js",
   "tailbone/mesh/js/Channel.js",
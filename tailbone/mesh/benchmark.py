@@ -0,0 +1,87 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Join and leave storms against the mesh server state, without sockets.
+#
+#   python tailbone/mesh/benchmark.py --nodes 5000 --rooms 2
+
+import logging
+import random
+import time
+from optparse import OptionParser
+
+import websocket
+
+
+class FakeNode(object):
+  """Stands in for a websocket Handler, counts the frames written to it."""
+
+  def __init__(self, protocol):
+    self.protocol = protocol
+    self.frames = 0
+    self.bytes = 0
+
+  def write_message(self, message, binary=False):
+    self.frames += 1
+    self.bytes += len(message)
+
+  def close(self):
+    pass
+
+
+def run(node_count, room_count, seed, protocol=websocket.JSON):
+  """Joins node_count nodes to each room, then has them leave in random order.
+
+  Returns:
+    A tuple of the seconds spent joining, the seconds spent leaving and the
+      number of frames written.
+  """
+  rng = random.Random(seed)
+  rooms = ["room-{}".format(i) for i in range(room_count)]
+  joined = []
+  start = time.time()
+  for i in range(node_count):
+    for room in rooms:
+      node = FakeNode(protocol)
+      websocket.enter(node, room)
+      joined.append(node)
+  entered = time.time()
+  leaving = list(joined)
+  rng.shuffle(leaving)
+  for node in leaving:
+    websocket.leave(node)
+  left = time.time()
+  assert not websocket.meshes_by_id and not websocket.nodes_by_id
+  return entered - start, left - entered, sum(n.frames for n in joined)
+
+
+def main():
+  parser = OptionParser()
+  parser.add_option('-n', '--nodes', dest='nodes', type='int', default=2000, help='nodes joining each room')
+  parser.add_option('-r', '--rooms', dest='rooms', type='int', default=1, help='number of rooms')
+  parser.add_option('-s', '--seed', dest='seed', type='int', default=0, help='seed of the leave order')
+  parser.add_option('-m', '--msgpack', dest='msgpack', action='store_true', default=False, help='nodes speak msgpack')
+  (options, args) = parser.parse_args()
+  logging.getLogger().setLevel(logging.WARNING)
+
+  protocol = websocket.MSGPACK if options.msgpack else websocket.JSON
+  joins, leaves, frames = run(options.nodes, options.rooms, options.seed, protocol)
+  total = options.nodes * options.rooms
+  print '%d nodes in %d rooms' % (total, options.rooms)
+  print 'join  %.3fs (%.1f us per node)' % (joins, joins / total * 1e6)
+  print 'leave %.3fs (%.1f us per node)' % (leaves, leaves / total * 1e6)
+  print '%d frames written' % frames
+
+if __name__ == "__main__":
+  main()
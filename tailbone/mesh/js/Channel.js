@@ -40,6 +40,16 @@ Channel.prototype.close = function () {
 
 };
 
+/**
+ * Whether send takes arrays holding binary values besides json strings
+ * @returns {boolean}
+ */
+Channel.prototype.sendsBinary = function () {
+
+  return false;
+
+};
+
 /**
  * Sends message to remoteNode
  * @param message
@@ -133,9 +133,10 @@ Mesh.prototype.connect = function () {
 
   if (this.options.ws) {
 
-    idMatch = this.options.ws.match('[^\/]+$');
+    // federated rooms carry the relay hosts in the query
+    idMatch = this.options.ws.match(/([^\/?]+)(\?.*)?$/);
     if (idMatch) {
-      this.id = idMatch[0];
+      this.id = idMatch[1];
     }
 
     this.self.connect();
@@ -230,7 +231,8 @@ Mesh.prototype.trigger = function (type, args) {
 
 /**
  * Common Mesh options
- * @type {{api: '/api/mesh', autoConnect: boolean}}
+ * binary asks the websocket server for msgpack frames, falling back to json
+ * @type {{api: '/api/mesh', autoConnect: boolean, binary: boolean}}
  */
 Mesh.options = {
 
@@ -238,6 +240,7 @@ Mesh.options = {
   autoConnect: true,
   autoPeerConnect: true,
   useWebRTC: true,
+  binary: false,
   delay: undefined
 
 };
@@ -18,18 +18,39 @@ var NodeUtils = {
 
   send: function (node, message) {
 
+    var binary = typeof message !== 'string';
     var sendChannel = node._channels.filter(function(c) {
-      return c.getState() === Channel.STATE.OPEN;
+      return c.getState() === Channel.STATE.OPEN && (!binary || c.sendsBinary());
     })[0];
 
     if (sendChannel) {
       sendChannel.send(message);
     } else {
-      console.warn('There is no open send channel.');
+      console.warn(binary ? 'There is no open binary send channel.' : 'There is no open send channel.');
     }
 
   },
 
+  /**
+   * Whether event arguments hold ArrayBuffers or typed arrays
+   * @param args {Array}
+   * @returns {boolean}
+   */
+  hasBinary: function (args) {
+
+    if (typeof ArrayBuffer === 'undefined') {
+      return false;
+    }
+    for (var i = 0; i < args.length; ++i) {
+      var arg = args[i];
+      if (arg && (arg instanceof ArrayBuffer || arg.buffer instanceof ArrayBuffer)) {
+        return true;
+      }
+    }
+    return false;
+
+  },
+
   acknowledgeRemoteBind: function (nodeId, type) {
 
     NodeUtils.remoteBindsByNodeIds[nodeId] = NodeUtils.remoteBindsByNodeIds[nodeId] || [];
@@ -276,9 +297,14 @@ Node.prototype._trigger = function (type, args) {
 
   try {
     var outgoing = this.preprocessOutgoing.apply(this, arguments);
-    message = JSON.stringify(Array.prototype.slice.apply(outgoing));
-    if (message === 'null') {
-      return;
+    if (NodeUtils.hasBinary(outgoing)) {
+      // sent as is over a msgpack socket instead of base64 inflated json
+      message = Array.prototype.slice.apply(outgoing);
+    } else {
+      message = JSON.stringify(Array.prototype.slice.apply(outgoing));
+      if (message === 'null') {
+        return;
+      }
     }
 
   } catch (e) {
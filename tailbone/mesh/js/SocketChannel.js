@@ -42,9 +42,17 @@ SocketChannel.prototype.close = function () {
   this.multiplexer.close(this);
 };
 
+/**
+ * Whether send takes binary messages, see Node.prototype._trigger
+ * @returns {boolean}
+ */
+SocketChannel.prototype.sendsBinary = function () {
+  return this.multiplexer.binary;
+};
+
 /**
  * Sends message to remoteNode
- * @param message {string}
+ * @param message {string|Array} json string, or an array holding binary values
  */
 SocketChannel.prototype.send = function (message) {
   this.multiplexer.send(this, message);
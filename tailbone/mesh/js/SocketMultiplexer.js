@@ -14,10 +14,39 @@ var SocketMultiplexer = function(mesh) {
   this.setState(Channel.STATE.CLOSED);
   this.setMinCallState('send', Channel.STATE.OPEN);
   this.channels = {};
+  // true once the server agreed to msgpack frames for this connection
+  this.binary = false;
+  this.jsonOnly = false;
 };
 
 SocketMultiplexer._byMesh = {};
 
+/**
+ * WebSocket subprotocols, a connection that asks for neither speaks json
+ */
+SocketMultiplexer.PROTOCOL = {
+  JSON: 'tailbone-json',
+  MSGPACK: 'tailbone-msgpack'
+};
+
+/**
+ * Decodes a websocket frame, text frames are json and binary frames msgpack.
+ * Returns the [from, payload] of the frame, payloads that are strings hold json.
+ */
+SocketMultiplexer.decode = function(frame) {
+  var container;
+  if (typeof frame === 'string') {
+    container = JSON.parse(frame);
+  } else {
+    container = msgpack.unpack(frame);
+  }
+  if (!container) {
+    throw new Error('Invalid container received');
+  }
+  var payload = container[container.length - 1];
+  return [container[0], typeof payload === 'string' ? JSON.parse(payload) : payload];
+};
+
 SocketMultiplexer.get = function(mesh) {
   var multiplexer = SocketMultiplexer._byMesh[mesh];
   if(!multiplexer) {
@@ -56,9 +85,18 @@ SocketMultiplexer.prototype.open = function(channel) {
   this.setState(Channel.STATE.OPENING);
 
   var self = this;
-  var socket = self.socket = new WebSocket(this.mesh.options.ws);
+  var protocols = SocketMultiplexer.PROTOCOL;
+  var askBinary = this.mesh.options.binary && !this.jsonOnly &&
+      typeof msgpack !== 'undefined' && typeof ArrayBuffer !== 'undefined';
+  var opened = false;
+  var socket = self.socket = askBinary ?
+      new WebSocket(this.mesh.options.ws, [protocols.MSGPACK, protocols.JSON]) :
+      new WebSocket(this.mesh.options.ws);
+  socket.binaryType = 'arraybuffer';
 
   socket.addEventListener('open', function(e) {
+    opened = true;
+    self.binary = socket.protocol === protocols.MSGPACK;
     self.setState(Channel.STATE.OPEN);
     // mark all attached channels as open
     for (var id in self.channels) {
@@ -71,19 +109,14 @@ SocketMultiplexer.prototype.open = function(channel) {
   }, false);
 
   socket.addEventListener('message', function(e) {
-    var container;
-    try {
-      container = JSON.parse(e.data);
-    } catch (err) {
-      throw new Error('Invalid container received', container);
-    }
-    var from = container[0];
-    var data;
+    var decoded;
     try {
-      data = JSON.parse(container[1]);
+      decoded = SocketMultiplexer.decode(e.data);
     } catch (err) {
-      throw new Error('Invalid data received', data);
+      throw new Error('Invalid container received', e.data);
     }
+    var from = decoded[0];
+    var data = decoded[1];
     // one time upgrade of self id upon connection
     if (data[0] === 'connect') {
       // find a null self node and upgrade it
@@ -107,6 +140,13 @@ SocketMultiplexer.prototype.open = function(channel) {
 
   socket.addEventListener('close', function() {
     self.setState(Channel.STATE.CLOSED);
+    self.binary = false;
+    if (askBinary && !opened) {
+      // servers without subprotocol support refuse the handshake, retry with json
+      self.jsonOnly = true;
+      self.open();
+      return;
+    }
     for (var id in self.channels) {
       var channel = self.channels[id];
       channel.setState(Channel.STATE.CLOSED);
@@ -119,6 +159,10 @@ SocketMultiplexer.prototype.open = function(channel) {
   }, false);
 
   socket.addEventListener('error', function() {
+    if (askBinary && !opened) {
+      // handled by the json retry on close
+      return;
+    }
     self.setState(Channel.STATE.CLOSED);
     for (var id in self.channels) {
       var channel = self.channels[id];
@@ -192,6 +236,10 @@ SocketMultiplexer.prototype.send = function(channel, message) {
   // return true;
 
   // TODO: user defer to batch send messages
+  if (this.binary) {
+    // strings stay json inside the msgpack frame, arrays are packed as is with binary values
+    return this.socket.send(new Uint8Array(msgpack.pack([[channel.remoteNode.id], message])).buffer);
+  }
   var encoded = JSON.stringify([[channel.remoteNode.id], message]);
   return this.socket.send(encoded);
 };
@@ -29,6 +29,10 @@ var _ie         = /MSIE/.test(navigator.userAgent),
     _isArray    = Array.isArray || (function(mix) {
                     return Object.prototype.toString.call(mix) === "[object Array]";
                   }),
+    _isBinary   = function(mix) {
+                    return typeof ArrayBuffer !== "undefined" &&
+                           (mix instanceof ArrayBuffer || mix.buffer instanceof ArrayBuffer);
+                  },
     _toString   = String.fromCharCode, // CharCode/ByteArray to String
     _MAX_DEPTH  = 512;
 
@@ -65,7 +69,8 @@ function msgpackunpack(data) { // @param BinaryString/ByteArray:
     //  [1][String to mix]    msgpack.unpack("...") -> {}
     //  [2][ByteArray to mix] msgpack.unpack([...]) -> {}
 
-    _buf = typeof data === "string" ? toByteArray(data) : data;
+    _buf = typeof data === "string" ? toByteArray(data) :
+           data instanceof ArrayBuffer ? new Uint8Array(data) : data;
     _idx = -1;
     return decode(); // mix or undefined
 }
@@ -199,7 +204,24 @@ function encode(rv,      // @param ByteArray: result
                                        (size >>  8) & 0xff, size & 0xff);
             }
             break;
-        default: // array or hash
+        default: // binary, array or hash
+            if (_isBinary(mix)) {
+                // ArrayBuffer or typed array -> bin 8/16/32
+                mix = new Uint8Array(mix.buffer || mix, mix.byteOffset || 0, mix.byteLength);
+                size = mix.length;
+                if (size < 0x100) {
+                    rv.push(0xc4, size);
+                } else if (size < 0x10000) {
+                    rv.push(0xc5, size >> 8, size & 0xff);
+                } else {
+                    rv.push(0xc6, size >>> 24, (size >> 16) & 0xff,
+                                               (size >>  8) & 0xff, size & 0xff);
+                }
+                for (i = 0; i < size; ++i) {
+                    rv.push(mix[i]);
+                }
+                break;
+            }
             if (++depth >= _MAX_DEPTH) {
                 _error = 1; // CYCLIC_REFERENCE_ERROR
                 return rv = []; // clear
@@ -265,11 +287,23 @@ function decode() { // @return Mix:
             num  = type - 0xa0;
             type = 0xa0;
         }
+    } else if (type === 0xd9) { // str 8, decoded like a FixRaw
+        num  = buf[++_idx];
+        type = 0xa0;
     }
     switch (type) {
     case 0xc0:  return null;
     case 0xc2:  return false;
     case 0xc3:  return true;
+    // 0xc6: bin32, 0xc5: bin16, 0xc4: bin8 -> Uint8Array
+    case 0xc6:  num +=  buf[++_idx] * 0x1000000 + (buf[++_idx] << 16);
+    case 0xc5:  num +=  buf[++_idx] << 8;
+    case 0xc4:  num +=  buf[++_idx];
+                ary = new Uint8Array(num);
+                for (i = 0; i < num; ++i) {
+                    ary[i] = buf[++_idx];
+                }
+                return ary;
     case 0xca:  // float
                 num = buf[++_idx] * 0x1000000 + (buf[++_idx] << 16) +
                                                 (buf[++_idx] <<  8) + buf[++_idx];
@@ -358,18 +392,9 @@ function decode() { // @return Mix:
     case 0xde:  num += (buf[++_idx] << 8)       +  buf[++_idx];
     case 0x80:  hash = {};
                 while (num--) {
-                    // make key/value pair
-                    size = buf[++_idx] - 0xa0;
-
-                    for (ary = [], i = _idx, iz = i + size; i < iz; ) {
-                        c = buf[++i]; // lead byte
-                        ary.push(c < 0x80 ? c : // ASCII(0x00 ~ 0x7f)
-                                 c < 0xe0 ? ((c & 0x1f) <<  6 | (buf[++i] & 0x3f)) :
-                                            ((c & 0x0f) << 12 | (buf[++i] & 0x3f) << 6
-                                                              | (buf[++i] & 0x3f)));
-                    }
-                    _idx = i;
-                    hash[_toString.apply(null, ary)] = decode();
+                    // make key/value pair, keys may be any string type
+                    size = decode();
+                    hash[size] = decode();
                 }
                 return hash;
     // 0xdd: array32, 0xdc: array16, 0x90: array
@@ -8,7 +8,13 @@ var app = http.createServer(function(req, res) {
   res.end(''+_count);
 });
 
-var wss = new WebSocketServer({server: app});
+var wss = new WebSocketServer({
+  server: app,
+  // only json frames are understood here, so never accept the msgpack subprotocol a client offers
+  handleProtocols: function(protocols, cb) {
+    cb(true, protocols.indexOf('tailbone-json') >= 0 ? 'tailbone-json' : undefined);
+  }
+});
 
 var _count = 0;
 var _global_id = 0;
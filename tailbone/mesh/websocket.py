@@ -3,43 +3,80 @@
 # @author Maciej Zasada maciej@unit9.com
 ##
 
+import collections
+import hashlib
+import hmac
 import json
+import marshal
+import os
+import socket
+import struct
+import tempfile
 import time
 from optparse import OptionParser
 import logging
 import tornado.httpserver
+import tornado.iostream
+import tornado.netutil
+import tornado.process
+import tornado.tcpserver
 import tornado.websocket
 import tornado.ioloop
 import tornado.web
 
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+# websocket subprotocols, a connection that asks for neither speaks json
+JSON = 'tailbone-json'
+MSGPACK = 'tailbone-msgpack'
+
 node_id_seed = 1
-nodes = []
+# added to every node ID, the last 16 bits of the relay address and 5 bits counting the starts of
+# the worker above the 32 bits of the local IDs, so that neither another instance of a federation
+# nor a restarted worker hands out the IDs of an earlier one and they stay within the exact
+# integers of javascript
+node_id_base = 0
 nodes_by_id = {}
+# mesh id to an ordered dict of node id to node, in the order the nodes entered
 meshes_by_id = {}
 mesh_id_by_node = {}
 
+# with --workers every process holds its own nodes, and learns the nodes of the others over the bus
+worker_index = 0
+worker_count = 1
+bus = None
+# with --secret worker 0 relays between this instance and the other instances hosting its meshes
+relay = None
+relay_secret = None
+# mesh id to an ordered dict of node id to peer, for nodes held elsewhere. The peer is the index of
+# the worker holding the node, or the address of the instance the node was relayed from.
+remote_meshes_by_id = {}
+peer_by_node_id = {}
+
 
 def enter(node, mesh_id):
   """Joins a node to a mesh. Creates new mesh if needed."""
   node.id = new_node_id()
   node.is_initiator_by_peer_node_id = {}
-  nodes.append(node)
   nodes_by_id[node.id] = node
 
-  if not mesh_id in meshes_by_id:
-    meshes_by_id[mesh_id] = []
-  mesh = meshes_by_id[mesh_id]
-  mesh.append(node)
+  mesh = meshes_by_id.get(mesh_id)
+  if mesh is None:
+    mesh = meshes_by_id[mesh_id] = collections.OrderedDict()
+  # the peers already in the mesh, read before the node is added to skip filtering it out
+  exist = get_exist(mesh_id, node.id)
+  mesh[node.id] = node
   mesh_id_by_node[node] = mesh_id
 
   logging.debug('enter (node ID: %s, mesh ID: %s)' % (node.id, mesh_id))
   # exist should be the first thing sent
-  send_to_node(node, node, json.dumps(['connect'] + get_exist(mesh, node.id)))
+  send_to_node(node, node, json.dumps(['connect'] + exist))
   # make the enter call be a self message for routing
-  msg = json.dumps(['enter', node.id])
-  for n in mesh:
-    if n != node:
-      send_to_node(n, n, msg)
+  send_to_peers(mesh, node, json.dumps(['enter', node.id]))
+  publish(['enter', mesh_id, node.id])
 
   # send_to_mesh(mesh, node, ['enter', node.id])
   return True
@@ -49,19 +86,18 @@ def leave(node):
   """Removes node from meshes, disconnects node."""
   if not node:
     return
-  mesh_id = mesh_id_by_node[node]
+  # closing the node below can call back into leave
+  mesh_id = mesh_id_by_node.pop(node, None)
+  if mesh_id is None:
+    return
   mesh = meshes_by_id[mesh_id]
-  del mesh_id_by_node[node]
-  mesh.remove(node)
-  if len(mesh) == 0:
+  del mesh[node.id]
+  if not mesh:
     del meshes_by_id[mesh_id]
   else:
-    msg = json.dumps(['leave', node.id])
-    for n in mesh:
-      if n != node:
-        send_to_node(n, n, msg)
-  nodes.remove(node)
+    send_to_peers(mesh, node, json.dumps(['leave', node.id]))
   del nodes_by_id[node.id]
+  publish(['leave', mesh_id, node.id])
   try:
     node.close()
   except:
@@ -71,13 +107,11 @@ def leave(node):
 
 def parse_message(node, message):
   """Interprets node message and directs it forward."""
-  mesh_id = mesh_id_by_node[node]
   message_object = None
   to_nodes = None
   message_data = None
-  print 'received %s (node ID: %s, mesh ID: %s)' % (message, node.id, mesh_id)
   try:
-    message_object = json.loads(message)
+    message_object = decode(message)
     to_nodes = message_object[0]
     # check if it is a list of messages
     if type(to_nodes[0]) is list:
@@ -86,71 +120,554 @@ def parse_message(node, message):
         send_to_node_ids(to_nodes, node, message_data)
       return
     message_data = message_object[1]
-  except AttributeError as e:
-    print e
+  except (AttributeError, IndexError, TypeError, ValueError) as e:
+    logging.warning('invalid message from node %s: %s' % (node.id, e))
     return
   send_to_node_ids(to_nodes, node, message_data)
 
 
+def encode(protocol, value):
+  """Encodes a value as a frame of a protocol."""
+  if protocol == MSGPACK:
+    return msgpack.packb(value, use_bin_type=True)
+  return json.dumps(value)
+
+
+def decode(message):
+  """Decodes an inbound frame, text frames are json and binary frames msgpack."""
+  if isinstance(message, unicode):
+    return json.loads(message)
+  if not msgpack:
+    raise ValueError('binary frames need msgpack')
+  return msgpack.unpackb(message, raw=False)
+
+
+class Frame(object):
+  """An outbound message, encoded at most once for each protocol."""
+
+  def __init__(self, value):
+    self.value = value
+    self.encoded = {}
+
+  def get(self, protocol):
+    """Gets the encoded frame, None if the message can not be sent in the protocol."""
+    if protocol not in self.encoded:
+      try:
+        self.encoded[protocol] = encode(protocol, self.value)
+      except (TypeError, ValueError, OverflowError):
+        # binary payloads have no json encoding
+        self.encoded[protocol] = None
+    return self.encoded[protocol]
+
+
 def wrap_message(message, sender_node):
   """Wraps message with sender ID and timestamp."""
-  try:
-    message_string = json.dumps([sender_node.id, time.time(), message])
-    return message_string
-  except:
-    return None
+  return Frame([sender_node.id, time.time(), message])
 
 
-def send_to_node(node, sender_node, message):
-  """Sends message to a node."""
-  message_string = wrap_message(message, sender_node)
-  if message_string:
-    logging.info('sending to node %s (node ID: %s, to ID: %s)' % (message_string, sender_node.id, node.id))
+def write_frame(nodes, frame):
+  """Writes one frame to every node in the protocol of the node, returns the nodes skipped."""
+  skipped = 0
+  for node in nodes:
+    data = frame.get(node.protocol)
+    if data is None:
+      skipped += 1
+      continue
     try:
-      node.write_message(message_string)
+      node.write_message(data, binary=node.protocol == MSGPACK)
     except:
       pass
+  return skipped
+
+
+def send_to_nodes(nodes, sender_node, message):
+  """Sends message to a list of nodes, encoding it once for all of them."""
+  if write_frame(nodes, wrap_message(message, sender_node)):
+    logging.warning('invalid message format from node %s' % sender_node.id)
+
+
+def send_to_node(node, sender_node, message):
+  """Sends message to a node."""
+  send_to_nodes([node], sender_node, message)
 
 
 def send_to_node_ids(node_ids, sender_node, message):
-  """Sends message to array of nodes."""
+  """Sends message to array of nodes, wherever they are held."""
+  if route(node_ids, wrap_message(message, sender_node)):
+    logging.warning('invalid message format from node %s' % sender_node.id)
+
+
+def route(node_ids, frame, source=None):
+  """Writes a frame to the local nodes of a list and forwards it toward the others.
+
+  Frames that came over the bus or a relay are not sent back the same way.
+  Returns the number of local nodes the frame could not be encoded for.
+  """
+  local = []
+  remote = {}
   for node_id in node_ids:
-    if node_id in nodes_by_id:
-      send_to_node(nodes_by_id[node_id], sender_node, message)
- 
+    node = nodes_by_id.get(node_id)
+    if node:
+      local.append(node)
+    elif node_id in peer_by_node_id:
+      peer = peer_by_node_id[node_id]
+      if links_for(peer) is not source:
+        remote.setdefault(peer, []).append(node_id)
+  skipped = write_frame(local, frame)
+  for peer, ids in remote.iteritems():
+    links_for(peer).send(peer, ['send', ids] + frame.value)
+  return skipped
+
 
 def send_to_mesh(mesh, sender_node, message):
   """Sends message to a mesh."""
-  message_string = wrap_message(message, sender_node)
-  if message_string:
-    logging.info('sending to mesh %s (node ID: %s, mesh ID: *)' % (message_string, sender_node.id))
-    for node in mesh:
-      if node != sender_node:
-        try:
-          node.write_message(message_string)
-        except:
-          pass
-  else:
-    logging.warning('invalid message format %s' % message)
+  send_to_nodes([node for node in mesh.itervalues() if node is not sender_node],
+                sender_node, message)
 
 
-def get_exist(mesh, ignore):
-  """Gets a list of connected node IDs by mesh."""
-  return [node.id for node in mesh if node.id != ignore]
+def send_to_peers(mesh, node, message):
+  """Sends message to the other nodes of a mesh, each as a message from itself for routing."""
+  # only the leading sender ID differs between recipients, the rest is encoded once per protocol
+  now = time.time()
+  tails = {}
+  for n in mesh.itervalues():
+    if n is node:
+      continue
+    if n.protocol not in tails:
+      tails[n.protocol] = encode_tail(n.protocol, now, message)
+    try:
+      n.write_message(self_frame(n.protocol, n.id, tails[n.protocol]),
+                      binary=n.protocol == MSGPACK)
+    except:
+      pass
+
+
+def encode_tail(protocol, timestamp, message):
+  """Encodes the part of a wrapped message after the sender ID."""
+  if protocol == MSGPACK:
+    return msgpack.packb(timestamp) + msgpack.packb(message, use_bin_type=True)
+  return json.dumps([timestamp, message])[1:]
+
+
+def self_frame(protocol, node_id, tail):
+  """Completes a wrapped message sent from node_id to itself, see encode_tail."""
+  if protocol == MSGPACK:
+    # a fixarray of three elements
+    return '\x93' + msgpack.packb(node_id) + tail
+  return '[%d, %s' % (node_id, tail)
+
+
+def get_exist(mesh_id, ignore):
+  """Gets a list of connected node IDs by mesh, on every worker."""
+  node_ids = [node_id for node_id in meshes_by_id.get(mesh_id, ()) if node_id != ignore]
+  node_ids.extend(node_id for node_id in remote_meshes_by_id.get(mesh_id, ()) if node_id != ignore)
+  return node_ids
 
 
 def new_node_id():
-  """Generates new node ID."""
+  """Generates new node ID, workers hand out interleaved IDs so they never collide."""
   global node_id_seed
-  node_id = node_id_seed
+  node_id = node_id_base + node_id_seed * worker_count + worker_index
   node_id_seed = node_id_seed + 1
   return node_id
 
 
+def make_node_id_base(address, starts, prefix=None):
+  """The node ID base of a worker from the relay address of its instance and its start count."""
+  if prefix is None:
+    prefix = struct.unpack('!I', socket.inet_aton(socket.gethostbyname(address)))[0]
+  return ((prefix & 0xffff) << 5 | starts % 32) << 32
+
+
+def count_start(directory, index):
+  """Counts the starts of a worker in the directory of the bus, returns the earlier starts."""
+  path = os.path.join(directory, 'worker-%d.starts' % index)
+  try:
+    with open(path) as f:
+      starts = int(f.read() or 0)
+  except IOError:
+    starts = 0
+  # only this worker writes its count, the parent restarts it after it died
+  with open(path, 'w') as f:
+    f.write(str(starts + 1))
+  return starts
+
+
+def links_for(peer):
+  """Gets the Links reaching a peer, the bus for workers and the relay for instances."""
+  return bus if isinstance(peer, (int, long)) else relay
+
+
+def publish(event, source=None):
+  """Sends a membership event to the other workers and instances, except back to its source."""
+  for links in (bus, relay):
+    if links and links is not source:
+      links.publish(event)
+
+
+def local_members():
+  """Gets the (mesh ID, node ID) pairs of the nodes of this process."""
+  return [[mesh_id, node_id] for mesh_id, mesh in meshes_by_id.iteritems() for node_id in mesh]
+
+
+def remote_members(held):
+  """Gets the (mesh ID, node ID) pairs of the nodes held elsewhere whose peer passes held."""
+  return [[mesh_id, node_id] for mesh_id, remote in remote_meshes_by_id.iteritems()
+          for node_id, peer in remote.iteritems() if held(peer)]
+
+
+def remote_enter(peer, mesh_id, node_id):
+  """Records a node that entered a mesh on another worker or instance."""
+  remote = remote_meshes_by_id.get(mesh_id)
+  if remote is None:
+    remote = remote_meshes_by_id[mesh_id] = collections.OrderedDict()
+  remote[node_id] = peer
+  peer_by_node_id[node_id] = peer
+  mesh = meshes_by_id.get(mesh_id)
+  if mesh:
+    send_to_peers(mesh, None, json.dumps(['enter', node_id]))
+  # worker 0 bridges the bus and the relay
+  publish(['enter', mesh_id, node_id], links_for(peer))
+
+
+def remote_leave(peer, mesh_id, node_id):
+  """Forgets a node that left a mesh on another worker or instance."""
+  remote = remote_meshes_by_id.get(mesh_id)
+  if not remote or remote.get(node_id) != peer:
+    return
+  del remote[node_id]
+  if not remote:
+    del remote_meshes_by_id[mesh_id]
+  del peer_by_node_id[node_id]
+  mesh = meshes_by_id.get(mesh_id)
+  if mesh:
+    send_to_peers(mesh, None, json.dumps(['leave', node_id]))
+  publish(['leave', mesh_id, node_id], links_for(peer))
+
+
+def set_remote_members(peer, members):
+  """Replaces the (mesh ID, node ID) pairs known on a peer, announcing the difference."""
+  members = set(tuple(member) for member in members)
+  current = set(tuple(member) for member in remote_members(lambda p: p == peer))
+  for mesh_id, node_id in current - members:
+    remote_leave(peer, mesh_id, node_id)
+  for mesh_id, node_id in members - current:
+    remote_enter(peer, mesh_id, node_id)
+
+
+def receive(links, peer, event):
+  """Applies an event from another worker or instance."""
+  kind = event[0]
+  if kind == 'send':
+    node_ids, sender_id, timestamp, message = event[1:]
+    route(node_ids, Frame([sender_id, timestamp, message]), links)
+  elif kind == 'enter':
+    remote_enter(peer, *event[1:])
+  elif kind == 'leave':
+    remote_leave(peer, *event[1:])
+  elif kind == 'sync':
+    set_remote_members(peer, event[1])
+  elif kind == 'hosts' and relay and links is bus:
+    # only workers forward the hosts lists of their joiners
+    relay.learn(event[1])
+
+
+def sign(secret, value):
+  return hmac.new(str(secret), str(value), hashlib.sha1).hexdigest()
+
+
+def verify(secret, value, signature):
+  """Checks a signature made by sign in constant time."""
+  try:
+    return hmac.compare_digest(sign(secret, value), str(signature))
+  except UnicodeError:
+    return False
+
+
+def join_federation(hosts, signature):
+  """Links with the instances of a signed hosts list, the first host is this instance.
+
+  The list is signed for joiners with a "hosts:" prefix, which no relay hello
+  carries, so a joiner can not pose as an instance.
+  """
+  if not hosts:
+    return
+  if not verify(relay_secret, 'hosts:' + hosts, signature):
+    logging.warning('ignoring hosts without a valid signature: %s' % hosts)
+    return
+  hosts = hosts.split(',')
+  if relay:
+    relay.learn(hosts)
+  elif bus:
+    bus.send(0, ['hosts', hosts])
+
+
+class Links(object):
+  """Streams of events between this process and its peers, see Bus and Relay.
+
+  Every process listens for events and keeps one outbound stream to each peer.
+  The listener opens a stream with a random challenge, the sender answers with
+  a hello naming itself, then a sync of the nodes it announces. When the stream
+  closes those nodes are forgotten. The challenge and hello are json, the
+  events are encoded lists, each framed with its length.
+  """
+
+  family = socket.AF_UNIX
+  # seconds between attempts to reach a peer, and how many attempts, None for no limit
+  retry = 1
+  retries = None
+  # the largest hello a peer may send
+  max_hello = 1024
+
+  def __init__(self, key):
+    self.key = key
+    self.streams = {}
+    self.ready = set()
+    self.inbound = {}
+    self.failures = {}
+
+  def address(self, peer):
+    raise NotImplementedError()
+
+  def members(self):
+    """Gets the (mesh ID, node ID) pairs announced to the peers."""
+    raise NotImplementedError()
+
+  def hello(self, challenge):
+    return json.dumps([self.key, None])
+
+  def check_hello(self, peer, signature, challenge):
+    return True
+
+  def greeted(self, peer):
+    pass
+
+  def connect(self, peer):
+    if peer in self.streams:
+      return
+    stream = tornado.iostream.IOStream(socket.socket(self.family, socket.SOCK_STREAM))
+    self.streams[peer] = stream
+    stream.set_close_callback(lambda: self.disconnected(peer, stream))
+    stream.connect(self.address(peer), lambda: self.connected(peer, stream))
+
+  def connected(self, peer, stream):
+
+    def read_challenge(header):
+      size = struct.unpack('!I', header)[0]
+      if size > self.max_hello:
+        stream.close()
+        return
+      stream.read_bytes(size, answer)
+
+    def answer(challenge):
+      self.failures.pop(peer, None)
+      stream.write(self.frame(self.hello(json.loads(challenge))))
+      stream.write(self.encode(['sync', self.members()]))
+      self.ready.add(peer)
+
+    stream.read_bytes(4, read_challenge)
+
+  def disconnected(self, peer, stream):
+    if self.streams.get(peer) is not stream:
+      return
+    del self.streams[peer]
+    self.ready.discard(peer)
+    failures = self.failures[peer] = self.failures.get(peer, 0) + 1
+    if self.retries is not None and failures > self.retries:
+      # forgotten until it is named again
+      del self.failures[peer]
+      return
+    tornado.ioloop.IOLoop.instance().add_timeout(time.time() + self.retry,
+                                                 lambda: self.connect(peer))
+
+  def frame(self, data):
+    return struct.pack('!I', len(data)) + data
+
+  def encode(self, event):
+    return self.frame(marshal.dumps(event))
+
+  def decode(self, data):
+    return marshal.loads(data)
+
+  def send(self, peer, event):
+    """Sends an event to one peer, dropped while it is unreachable."""
+    if peer in self.ready:
+      self.write(peer, self.encode(event))
+
+  def publish(self, event):
+    """Sends an event to every peer."""
+    data = self.encode(event)
+    for peer in list(self.ready):
+      self.write(peer, data)
+
+  def write(self, peer, data):
+    stream = self.streams[peer]
+    # the close callback runs on a later tick
+    if not stream.closed():
+      stream.write(data)
+
+  def accept(self, stream):
+    """Reads the events a peer sends on an inbound stream."""
+    sender = {}
+    challenge = os.urandom(16).encode('hex')
+
+    def read_header():
+      stream.read_bytes(4, read_data)
+
+    def read_data(header):
+      size = struct.unpack('!I', header)[0]
+      if 'peer' not in sender and size > self.max_hello:
+        stream.close()
+        return
+      stream.read_bytes(size, handle)
+
+    def handle(data):
+      if 'peer' in sender:
+        try:
+          event = self.decode(data)
+        except (TypeError, ValueError):
+          logging.warning('closing a link that sent an invalid event')
+          stream.close()
+          return
+        receive(self, sender['peer'], event)
+      else:
+        try:
+          peer, signature = json.loads(data)
+        except (TypeError, ValueError):
+          peer, signature = None, None
+        if peer is None or not self.check_hello(peer, signature, challenge):
+          logging.warning('closing a link without a valid hello')
+          stream.close()
+          return
+        sender['peer'] = peer
+        # a reconnected peer replaces its previous stream
+        self.inbound[peer] = stream
+        self.greeted(peer)
+      read_header()
+
+    def closed():
+      peer = sender.get('peer')
+      if peer is not None and self.inbound.get(peer) is stream:
+        del self.inbound[peer]
+        set_remote_members(peer, [])
+
+    stream.set_close_callback(closed)
+    stream.write(self.frame(json.dumps(challenge)))
+    read_header()
+
+
+class LinkServer(tornado.tcpserver.TCPServer):
+  """Accepts the inbound streams of a Links."""
+
+  def __init__(self, links):
+    super(LinkServer, self).__init__()
+    self.links = links
+
+  def handle_stream(self, stream, address):
+    self.links.accept(stream)
+
+
+class Bus(Links):
+  """Links the workers of a server with unix sockets in a private directory."""
+
+  def __init__(self, directory, index, count):
+    super(Bus, self).__init__(index)
+    self.directory = directory
+    self.count = count
+
+  def address(self, index):
+    return os.path.join(self.directory, 'worker-%d.sock' % index)
+
+  def members(self):
+    # worker 0 also announces the nodes relayed from other instances
+    return local_members() + remote_members(lambda peer: not isinstance(peer, (int, long)))
+
+  def start(self):
+    LinkServer(self).add_socket(tornado.netutil.bind_unix_socket(self.address(self.key), mode=0600))
+    for index in range(self.count):
+      if index != self.key:
+        self.connect(index)
+
+
+class Relay(Links):
+  """Links the instances hosting the same meshes over tcp, see FEDERATE in tailbone.mesh.
+
+  The key of an instance is its host:port address on the internal network,
+  learned from the first signed hosts list a joiner brings. Peers prove they
+  share the secret by signing the challenge of the stream and their key. The
+  events are msgpack rather than marshal, which is not safe to decode from
+  another machine.
+  """
+
+  family = socket.AF_INET
+  retry = 2
+  retries = 5
+
+  def __init__(self, address, port, secret):
+    super(Relay, self).__init__(None)
+    self.bind_address = address
+    self.port = port
+    self.secret = secret
+    # peers that linked to this instance before it knew its own address
+    self.waiting = set()
+
+  def address(self, peer):
+    host, port = peer.rsplit(':', 1)
+    return (host, int(port))
+
+  def members(self):
+    return local_members() + remote_members(lambda peer: isinstance(peer, (int, long)))
+
+  def encode(self, event):
+    return self.frame(msgpack.packb(event, use_bin_type=True))
+
+  def decode(self, data):
+    return msgpack.unpackb(data, raw=False)
+
+  def hello(self, challenge):
+    return json.dumps([self.key, sign(self.secret, 'relay:%s:%s' % (challenge, self.key))])
+
+  def check_hello(self, peer, signature, challenge):
+    return (isinstance(peer, basestring) and ':' in peer and peer != self.key and
+            verify(self.secret, 'relay:%s:%s' % (challenge, peer), signature))
+
+  def greeted(self, peer):
+    # link back so the peer learns the nodes of this instance
+    if self.key is None:
+      self.waiting.add(peer)
+    else:
+      self.connect(peer)
+
+  def learn(self, hosts):
+    """Links with the hosts of a mesh, the first host is this instance."""
+    if self.key is None:
+      self.key = hosts[0]
+      hosts = hosts + list(self.waiting)
+      self.waiting.clear()
+    for host in hosts:
+      if host != self.key:
+        self.connect(host)
+
+  def start(self):
+    LinkServer(self).listen(self.port, address=self.bind_address)
+
+
 class Handler(tornado.websocket.WebSocketHandler):
   """WebSocket connection and message handler."""
 
+  protocol = JSON
+
+  def select_subprotocol(self, subprotocols):
+    """Picks the first protocol the client offers that the server speaks."""
+    for protocol in subprotocols:
+      if protocol == JSON or (protocol == MSGPACK and msgpack):
+        self.protocol = protocol
+        return protocol
+    return None
+
   def open(self):
+    if relay_secret:
+      join_federation(self.get_argument('hosts', ''), self.get_argument('sig', ''))
     enter(self, self.request.path[1:])
 
   def on_message(self, message):
@@ -162,16 +679,46 @@ class Handler(tornado.websocket.WebSocketHandler):
 
 def main():
   """Instantiates WebSocket server Usage: TODO: add usage notes"""
+  global worker_index, worker_count, bus, relay, relay_secret, node_id_base
   parser = OptionParser()
   parser.add_option('-d', '--debug', dest='debug', action='store_true', help='enables debug mode', metavar='DEBUG', default=False)
   parser.add_option('-p', '--port', dest='port', help='port number to run the server on', metavar='PORT', default=2345)
   parser.add_option('-u', '--url', dest='url', help='base URL for connections', metavar='URL', default='')
   parser.add_option('-r', '--report', dest='report', help='URL to report load to', metavar='REPORT', default='')
+  parser.add_option('-s', '--secret', dest='secret', help='secret shared by the federated instances, enables the relay', metavar='SECRET', default=None)
+  parser.add_option('--relay-port', dest='relay_port', type='int', help='port the instances relay on', metavar='RELAY_PORT', default=8890)
+  parser.add_option('--relay-address', dest='relay_address', help='internal address the relay listens on', metavar='RELAY_ADDRESS', default='127.0.0.1')
+  parser.add_option('--node-prefix', dest='node_prefix', type='int', help='16 bit prefix of the node IDs, unique in the federation, defaults to the end of the relay address', metavar='NODE_PREFIX', default=None)
+  parser.add_option('-w', '--workers', dest='workers', type='int', help='worker processes sharing the port with SO_REUSEPORT, 0 for one per core', metavar='WORKERS', default=1)
   (options, args) = parser.parse_args()
 
-  server = tornado.httpserver.HTTPServer(tornado.web.Application([(options.url + '/.*', Handler)]))
   logging.getLogger().setLevel(logging.DEBUG if options.debug else logging.INFO)
-  server.listen(options.port)
+  if options.secret:
+    if options.secret == 'notasecret':
+      parser.error('--secret is still the default, pick your own')
+    if not msgpack:
+      parser.error('--secret needs the msgpack package for the relay')
+    relay_secret = options.secret
+  starts = 0
+  if options.workers == 1:
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(options.url + '/.*', Handler)]))
+    server.listen(options.port)
+  else:
+    worker_count = options.workers or tornado.process.cpu_count()
+    directory = tempfile.mkdtemp(prefix='tailbone-mesh-')
+    # the parent stays here restarting workers that die
+    worker_index = tornado.process.fork_processes(worker_count)
+    starts = count_start(directory, worker_index)
+    bus = Bus(directory, worker_index, worker_count)
+    bus.start()
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(options.url + '/.*', Handler)]))
+    server.add_sockets(tornado.netutil.bind_sockets(options.port, reuse_port=True))
+  if relay_secret or worker_count > 1:
+    # instances of a federation must differ in the last two bytes of their relay address
+    node_id_base = make_node_id_base(options.relay_address, starts, options.node_prefix)
+  if relay_secret and worker_index == 0:
+    relay = Relay(options.relay_address, options.relay_port, relay_secret)
+    relay.start()
   logging.debug('starting server on port %s' % options.port)
   tornado.ioloop.IOLoop.instance().start()
 
@@ -55,22 +55,33 @@ from tailbone import as_json
 from tailbone import BaseHandler
 from tailbone import BreakError
 from tailbone import DEBUG
+from tailbone import json_extras
 from tailbone import compile_js
 from tailbone import config
 from tailbone import LoginError
 from tailbone import parse_body
 from tailbone import PREFIX
+from tailbone import ReloadableConfig
 from tailbone import search
+from tailbone.restful import aggregate
+from tailbone.restful import cache
 from tailbone.restful import counter
+from tailbone.restful import multiquery
+from tailbone.restful import planner
 
 import datetime
 import json
 import logging
 import os
 import re
+import threading
+import time
 import webapp2
 
 from google.appengine import api
+from google.appengine.api import namespace_manager
+from google.appengine.datastore import datastore_query
+from google.appengine.datastore import datastore_rpc
 from google.appengine.ext import ndb
 
 
@@ -80,6 +91,33 @@ class _ConfigDefaults(object):
   # list of valid models, None means anything goes
   DEFINED_MODELS = None
   RESTRICT_TO_DEFINED_MODELS = True
+  # maximum number of items accepted by a single POST /api/{model}/_batch
+  BATCH_LIMIT = 500
+  # bytes of an ndjson upload handled by one import task, and objects per put_multi in that task
+  IMPORT_CHUNK_BYTES = 1 << 20
+  IMPORT_PUT_SIZE = 500
+  IMPORT_QUEUE = "default"
+  # cache the serialized results of GET by id in memcache, invalidated on put and delete
+  CACHE = False
+  # seconds a cached object lives, CACHE_TTLS can override it per model name {"todos": 300}
+  CACHE_TTL = 60
+  CACHE_TTLS = {}
+  # cache query pages in memcache, any write to a kind invalidates all of its cached queries
+  QUERY_CACHE = False
+  QUERY_CACHE_TTL = 30
+  # counts per value of a property, and the sum, min and max of a numeric property, maintained on
+  # put and delete per lowercase kind {"todos": [{"group": "Status", "value": "Points"}]}
+  AGGREGATES = {}
+  # normalize queries before running them, see planner.plan
+  QUERY_PLANNER = True
+  # most subqueries an OR or IN filter may expand into
+  MAX_SUBQUERIES = 30
+  # run the branches of OR and IN queries in parallel and page them with a composite cursor
+  PARALLEL_OR = True
+  # GET /api/{model}/_export stops after this many objects or seconds and returns a Cursor to resume
+  EXPORT_LIMIT = 10000
+  EXPORT_SECONDS = 50
+  EXPORT_BATCH_SIZE = 500
   PROTECTED_MODEL_NAMES = ["(?i)(mesh|messages|files|events|admin|proxy)",
                            "(?i)tailbone.*"]
   post_put_hook = None
@@ -88,7 +126,6 @@ _config = api.lib_config.register('tailboneRestful', _ConfigDefaults.__dict__)
 
 
 re_public = re.compile(r"^[A-Z].*")
-re_type = type(re_public)
 re_admin = re.compile(r"^(A|a)dmin.*")
 
 acl_attributes = [u"owners", u"viewers"]
@@ -102,36 +139,128 @@ def validate_modelname(model):
     raise ProtectedModelError
 
 
-def current_user(required=False):
+# The current user key and admin flag are looked up once per request and kept in the webapp2
+# request registry, serializing a page of objects would otherwise ask the users api for every one.
+def request_user():
+  try:
+    registry = webapp2.get_request().registry
+  except (AssertionError, AttributeError):
+    registry = None
+  if registry is not None:
+    context = registry.get("tailbone.restful.user")
+    if context is not None:
+      return context
   u = config.get_current_user()
+  context = (ndb.Key("users", u.user_id()) if u else None, bool(config.is_current_user_admin()))
+  if registry is not None:
+    registry["tailbone.restful.user"] = context
+  return context
+
+
+def current_user(required=False):
+  u = request_user()[0]
   if u:
-    return ndb.Key("users", u.user_id())
+    return u
   if required:
     raise LoginError("User must be logged in.")
   return None
 
+
+def is_admin():
+  return request_user()[1]
+
+# Start removing a written or deleted key from the read and query caches, returns the rpcs.
+def uncache_async(key):
+  rpcs = []
+  if _config.CACHE:
+    rpcs.append(cache.invalidate_async([key]))
+  if _config.QUERY_CACHE:
+    rpcs.append(cache.bump_generation_async(key.kind()))
+  return rpcs
+
+
+# Start updating the aggregates configured for the kind of key, returns a future or None.
+def aggregate_async(key, old, new):
+  kind = key.kind().lower()
+  specs = _config.AGGREGATES.get(kind)
+  if not specs:
+    return None
+  return aggregate.update_async(kind, specs, old, new)
+
+# Objects being deleted by key, loaded before the delete for the aggregates, kept per thread.
+_deleting = threading.local()
+
+def deleting():
+  entities = getattr(_deleting, "entities", None)
+  if entities is None:
+    entities = _deleting.entities = {}
+  return entities
+
+
 class HookedModel(ndb.Model):
 
   _previous = None
+  # set when _previous has already been loaded by the caller, e.g. a batch write
+  _prefetched = False
+  # set by the importer, which runs the access checks and the side effects of the hooks in bulk
+  _bulk = False
 
   def _pre_put_hook(self):
-    if self.key.id():
+    if not self._prefetched and self.key and self.key.id():
       self._previous = self.key.get()
 
   def _post_put_hook(self, future):
     future.wait()
-    search.put(self)
+    if self._bulk:
+      return
+    # start the search and counter rpcs together so their latencies overlap
+    indexing = search.put_async(self)
+    counting = None
     if _config.METADATA and self._previous is None:
-      counter.increment(self.__class__.__name__)
+      counting = counter.increment_async(self.__class__.__name__)
+    uncaching = uncache_async(self.key)
+    aggregating = aggregate_async(self.key, self._previous, self)
     if _config.post_put_hook:
       _config.post_put_hook(self)
+    if counting:
+      counting.get_result()
+    if aggregating:
+      aggregating.get_result()
+    for rpc in uncaching:
+      rpc.get_result()
+    search.wait(indexing)
+
+  # Property names are checked against re_public once per class and then looked up in a dict.
+  @classmethod
+  def _is_public_name(cls, name):
+    names = cls.__dict__.get("_public_names")
+    if names is None:
+      names = {}
+      cls._public_names = names
+    public = names.get(name)
+    if public is None:
+      public = names[name] = re_public.match(name) is not None
+    return public
+
+  @classmethod
+  def _pre_delete_hook(cls, key, entity=None):
+    if _config.AGGREGATES.get(key.kind().lower()):
+      deleting()[key] = entity if entity is not None else key.get()
 
   @classmethod
   def _post_delete_hook(cls, key, future):
+    deleted = deleting().pop(key, None)
     future.wait()
-    search.delete(key)
+    indexing = search.delete_async(key)
+    uncaching = uncache_async(key)
+    aggregating = aggregate_async(key, deleted, None) if deleted else None
     if _config.METADATA:
-      counter.decrement(cls.__name__)
+      counter.decrement_async(cls.__name__).get_result()
+    if aggregating:
+      aggregating.get_result()
+    for rpc in uncaching:
+      rpc.get_result()
+    search.wait(indexing)
 
 # Model
 # -----
@@ -143,7 +272,7 @@ class ScopedModel(HookedModel):
   viewers = ndb.KeyProperty(repeated=True)
 
   def can_write(self, u):
-    if config.is_current_user_admin():
+    if is_admin():
       return True
     try:
       owners = self.owners
@@ -154,7 +283,7 @@ class ScopedModel(HookedModel):
     return False
 
   def can_read(self, u):
-    if config.is_current_user_admin():
+    if is_admin():
       return True
     try:
       owners = self.owners
@@ -168,21 +297,32 @@ class ScopedModel(HookedModel):
       return True
     return False
 
+  # The owners and viewers, the full view and the public view as stored by the read cache.
+  def cache_views(self):
+    result = super(ScopedModel, self).to_dict()
+    result["Id"] = self.key.urlsafe()
+    public = dict((k, v) for k, v in result.iteritems() if k == "Id" or self._is_public_name(k))
+    acl = []
+    for name in acl_attributes:
+      try:
+        acl.extend(getattr(self, name))
+      except ndb.UnprojectedPropertyError:
+        pass
+    return acl, result, public
+
   def to_dict(self, *args, **kwargs):
     # pop kwargs recurse or 0
     result = super(ScopedModel, self).to_dict(*args, **kwargs)
     # expand(result, recurse)
     if not self.can_read(current_user()):
       # public properties only
-      for k in result.keys():
-        if not re_public.match(k):
-          del result[k]
+      result = dict((k, v) for k, v in result.iteritems() if self._is_public_name(k))
     result["Id"] = self.key.urlsafe()
     return result
 
   def _pre_put_hook(self):
     super(ScopedModel, self)._pre_put_hook()
-    if config.is_current_user_admin():
+    if is_admin() or self._bulk:
       return
     # check for writable and for any admin properties
     if self._previous is not None:
@@ -209,6 +349,7 @@ class ScopedModel(HookedModel):
     u = current_user(required=True)
     if not m.can_write(u):
       raise AppError("You ({}) do not have permission to delete this model ({}).".format(u, key.id()))
+    super(ScopedModel, cls)._pre_delete_hook(key, m)
 
 class ScopedExpando(ScopedModel, ndb.Expando):
   pass
@@ -223,16 +364,40 @@ class users(HookedModel, ndb.Expando):
     if u and u.urlsafe() == self.key.urlsafe():
       pass
     else:
-      for k in result.keys():
-        if not re_public.match(k):
-          del result[k]
+      result = dict((k, v) for k, v in result.iteritems() if self._is_public_name(k))
     result["Id"] = self.key.urlsafe()
-    admin = config.is_current_user_admin()
+    admin = is_admin()
     if admin:
       result["$admin"] = admin
     return result
 
 
+# Dynamic classes
+# ---------------
+# Model classes for kinds that are not in DEFINED_MODELS, and the Expando classes of nested
+# objects, are created the first time they are needed and reused for the life of the process.
+_dynamic_models = {}
+_structured_models = {}
+
+
+def dynamic_model(kind):
+  cls = _dynamic_models.get(kind)
+  if cls is None:
+    cls = _dynamic_models[kind] = type(kind, (ScopedExpando,), {})
+  elif ndb.Model._kind_map.get(kind) is not cls:
+    # a nested object class with the same name may have replaced it in the ndb kind map
+    cls._update_kind_map()
+  return cls
+
+
+def structured_model(name):
+  cls = _structured_models.get(name)
+  if cls is None:
+    subcls = unicode.encode(name, "ascii", errors="ignore") if isinstance(name, unicode) else name
+    cls = _structured_models[name] = type(subcls, (ndb.Expando,), {})
+  return cls
+
+
 # Reflectively instantiate a class given some data parsed by the restful json POST. If the size of
 # an object is larger than 500 characters it cannot be indexed. Otherwise everything else is. In the
 # future there may be a way to express what should be indexed or searchable, but not yet.
@@ -241,49 +406,80 @@ _reISO = re.compile("^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2}(?:\.\d*)?)Z
 _reKey = re.compile("^[a-zA-Z0-9_\-]{10,500}$")
 
 def reflective_create(cls, data):
-  m = cls()
+  return reflective_update(cls(), data)
+
+
+# Set the converted values of data on an existing model, used by reflective_create and PATCH.
+def reflective_update(m, data):
+  declared = m.__class__._properties
   for k, v in data.iteritems():
     m._default_indexed = True
-    t = type(v)
-    if t in [unicode, str]:
-      if len(bytearray(v, encoding="utf8")) >= 500:
-        m._default_indexed = False
-      elif _reISO.match(v):
-        try:
-          values = map(int, re.split('[^\d]', v)[:-1])
-          values[-1] *= 1000  # to account for python using microseconds vs js milliseconds
-          v = datetime.datetime(*values)
-        except ValueError as e:
-          # logging.info("{} key:'{}' value:{}".format(e, k, v))
-          pass
-      elif _reKey.match(v):
-        try:
-          v = ndb.Key(urlsafe=v)
-        except Exception as e:
-          logging.info("{} key:'{}' value:{}".format(e, k, v))
-          pass
-    elif t == list:
-      v = [convert_value(x, False) for x in v]
-    elif t == dict:
-      recurse = True
-      if set(v.keys()) == _latlon:
-        try:
-          v = ndb.GeoPt(v["lat"], v["lon"])
-          recurse = False
-        except api.datastore_errors.BadValueError as e:
-          #logging.error("{} key:'{}' value:{}".format(e, k, v))
-          pass
-      if recurse:
-        subcls = unicode.encode(k, "ascii", errors="ignore")
-        v = reflective_create(type(subcls, (ndb.Expando,), {}), v)
-    elif t == float:
-      v = float(v)
-    elif t == int:  # currently all numbers are floats for purpose of quering TODO find better solution
-      v = float(v)
+    convert = _converters.get(type(v))
+    if convert:
+      v = convert(m, k, v)
+    if k in m._properties and k not in declared:
+      # drop the loaded dynamic property so it is recreated with the indexing of the new value
+      delattr(m, k)
     setattr(m, k, v)
   return m
 
 
+def _parse_iso(v):
+  try:
+    values = map(int, re.split('[^\d]', v)[:-1])
+    values[-1] *= 1000  # to account for python using microseconds vs js milliseconds
+    return datetime.datetime(*values)
+  except ValueError as e:
+    # logging.info("{} value:{}".format(e, v))
+    return v
+
+
+def _convert_string(m, k, v):
+  n = len(v)
+  # cheap length bounds first, a character is at least one and at most three utf8 bytes (a
+  # surrogate pair is two characters and four bytes)
+  if n >= 500 or (n >= 167 and len(bytearray(v, encoding="utf8")) >= 500):
+    m._default_indexed = False
+  elif n >= 20 and v[10] == "T" and v[-1] == "Z" and _reISO.match(v):
+    v = _parse_iso(v)
+  elif n >= 10 and _reKey.match(v):
+    try:
+      v = ndb.Key(urlsafe=v)
+    except Exception as e:
+      logging.info("{} key:'{}' value:{}".format(e, k, v))
+  return v
+
+
+def _convert_list(m, k, v):
+  return [convert_value(x, False) for x in v]
+
+
+def _convert_dict(m, k, v):
+  if len(v) == 2 and set(v.keys()) == _latlon:
+    try:
+      return ndb.GeoPt(v["lat"], v["lon"])
+    except api.datastore_errors.BadValueError as e:
+      #logging.error("{} key:'{}' value:{}".format(e, k, v))
+      pass
+  return reflective_create(structured_model(k), v)
+
+
+# currently all numbers are floats for purpose of quering TODO find better solution
+def _convert_number(m, k, v):
+  return float(v)
+
+
+# Conversion of json values to datastore values by type, types not listed are stored as they are.
+_converters = {
+  str: _convert_string,
+  unicode: _convert_string,
+  list: _convert_list,
+  dict: _convert_dict,
+  float: _convert_number,
+  int: _convert_number,
+}
+
+
 # Strips any disallowed names {id, _*, etc}.
 def clean_data(data):
   disallowed_names = ["Id", "id", "key"]
@@ -328,13 +524,7 @@ def convert_value(value, parseFloat=True):
   elif value == "false":
     value = False
   elif _reISO.match(value):
-    try:
-      values = map(int, re.split('[^\d]', value)[:-1])
-      values[-1] *= 1000  # to account for python using microseconds vs js milliseconds
-      value = datetime.datetime(*values)
-    except ValueError as e:
-      # logging.info("{} key:'{}' value:{}".format(e, k, v))
-      pass
+    value = _parse_iso(value)
   elif _reKey.match(value):
     try:
       value = ndb.Key(urlsafe=value)
@@ -416,7 +606,7 @@ def construct_query_from_json(cls, filters, orders):
 def construct_query_from_url_args(cls, filters, orders):
   q = cls.query()
   q = q.filter(*[construct_filter(f) for f in filters])
-  # TODO(doug) correctly auto append orders when necessary like on a multiselect/OR
+  # orders needed by inequalities and OR filters are added by planner.plan
   q = q.order(*[construct_order(cls, o) for oo in orders for o in re_split.split(oo)])
   return q
 
@@ -432,18 +622,21 @@ def query(self, cls, *extra_filters):
     filters = params.get("filter")
     orders = params.get("order")
     projection = params.get("projection") or None
+    keys_only = params.get("keys_only", False)
     q = construct_query_from_json(cls, filters, orders)
+    orders = orders or []
   else:
     page_size = int(self.request.get("page_size", default_value=100))
     cursor = self.request.get("cursor")
     projection = self.request.get_all("projection")
     projection = [i for sublist in projection for i in sublist.split(",")] if projection else None
+    keys_only = self.request.get("keys_only") == "true"
     filters = self.request.get_all("filter")
     orders = self.request.get_all("order")
     q = construct_query_from_url_args(cls, filters, orders)
+    orders = [o for oo in orders for o in re_split.split(oo)]
   for f in extra_filters:
     q = f(q)
-  cursor = ndb.Cursor.from_websafe_string(cursor) if cursor else None
   if projection:
     # if asking for private variables and not specifing owners and viewers append them
     private = [p for p in projection if not re_public.match(p)]
@@ -451,30 +644,176 @@ def query(self, cls, *extra_filters):
       acl = [p for p in private if p in acl_attributes]
       if len(acl) == 0:
         raise AppError("Requesting projection of private properties, but did not specify 'owners' or 'viewers' to verify access.")
-  results, cursor, more = q.fetch_page(page_size, start_cursor=cursor, projection=projection)
-  self.response.headers["More"] = "true" if more else "false"
+  if _config.QUERY_PLANNER:
+    q = planner.plan(q, projection, _config.MAX_SUBQUERIES, _config.PARALLEL_OR)
+  # the cheap paths skip the query cache, reading them again costs about as much as a cache hit
+  if keys_only:
+    start = ndb.Cursor.from_websafe_string(cursor) if cursor else None
+    return iter_page(self, q, page_size, start, key_view, keys_only=True)
+  if raw_projection(cls, q, projection):
+    start = ndb.Cursor.from_websafe_string(cursor) if cursor else None
+    return iter_projection_page(self, cls, q, page_size, start, projection)
+  cached = None
+  if _config.QUERY_CACHE and issubclass(cls, ScopedModel):
+    cached = cache.query_name(q.kind, query_signature(q, orders, projection, page_size, cursor))
+    result = cache.get_query(cached)
+    if result is not None:
+      views, headers = result
+      for k, v in headers.iteritems():
+        self.response.headers[k] = v
+      return [owner if can_read_acl(acl) else public for acl, owner, public in views]
+  if _config.PARALLEL_OR and multiquery.applies(q):
+    results, cursor, more = multiquery.fetch_page(q, page_size, cursor, projection=projection)
+    # a composite cursor can only page forward
+    headers = {"More": "true" if more else "false", "Cursor": cursor}
+  else:
+    if multiquery.is_composite_cursor(cursor):
+      raise AppError("Cursor does not belong to this query.")
+    cursor = ndb.Cursor.from_websafe_string(cursor) if cursor else None
+    if not cached:
+      return iter_page(self, q, page_size, cursor, model_view, projection=projection)
+    results, cursor, more = q.fetch_page(page_size, start_cursor=cursor, projection=projection)
+    headers = page_headers(cursor, more)
+  for k, v in headers.iteritems():
+    self.response.headers[k] = v
+  if cached:
+    cache.set_query(cached, ([m.cache_views() for m in results], headers), _config.QUERY_CACHE_TTL)
+  return [m.to_dict() for m in results]
+
+
+def page_headers(cursor, more):
+  headers = {"More": "true" if more else "false"}
   if cursor:
-    self.response.headers["Cursor"] = cursor.urlsafe()
+    headers["Cursor"] = cursor.urlsafe()
     # The Reverse-Cursor is used if you construct a query in the opposite direction
-    self.response.headers["Reverse-Cursor"] = cursor.reversed().urlsafe()
-  return [m.to_dict() for m in results]
+    headers["Reverse-Cursor"] = cursor.reversed().urlsafe()
+  return headers
 
 
-# Helper function to validate the date recursively if needed.
-def _validate(validator, data, ignored=None):
-  if isinstance(validator, re_type):
-    if validator.pattern == "":
-      return
-    if type(data) not in [str, unicode]:
-      data = json.dumps(data)
-    if not validator.match(data):
-      raise AppError("Validator '{}' does not match '{}'".format(validator.pattern, data))
-  elif isinstance(validator, dict) and isinstance(data, dict):
-    for name, val in data.iteritems():
-      if name not in ignored:
-        _validate(validator.get(name), val)
-  else:
-    raise AppError("Unsupported validator type {} : {}".format(validator, type(validator)))
+def model_view(m):
+  return m.to_dict()
+
+
+def key_view(key):
+  return {"Id": key.urlsafe()}
+
+
+# Generator version of fetch_page that serializes each result as it arrives from the datastore, so
+# as_json can stream the page. The paging headers are set once the page is exhausted, this is fine
+# because the response is only sent after the handler returns.
+def iter_page(self, q, page_size, cursor, view, **options):
+  it = q.iter(limit=page_size + 1, batch_size=page_size, start_cursor=cursor,
+              produce_cursors=True, **options)
+  count = 0
+  while count < page_size and it.has_next():
+    yield view(it.next())
+    count += 1
+  try:
+    cursor = it.cursor_after()
+  except api.datastore_errors.BadArgumentError:
+    cursor = None
+  for k, v in page_headers(cursor, it.probably_has_next()).iteritems():
+    self.response.headers[k] = v
+
+
+# Projections of public, unstructured properties can be serialized straight from the returned
+# protobufs. Every user sees the same view of them, so no model instance is needed for the acl.
+#
+# Only the helpers below touch ndb internals, written against the ndb of the 1.9 Python SDK:
+# Query._get_query, Property._db_get_value, Property._opt_call_from_base_type and
+# model._BaseValue. If an SDK lacks any of them projections take the entity path.
+RAW_PROJECTION = (hasattr(ndb.Query, "_get_query") and
+                  hasattr(ndb.Property, "_db_get_value") and
+                  hasattr(ndb.Property, "_opt_call_from_base_type") and
+                  hasattr(ndb.model, "_BaseValue"))
+
+
+def _raw_run(q, conn, options):
+  return q._get_query(conn).run(conn, options)
+
+
+def _raw_value(prop, p):
+  value = prop._db_get_value(p.value(), p)
+  return prop._opt_call_from_base_type(ndb.model._BaseValue(value))
+
+
+def raw_projection(cls, q, projection):
+  # IN and != filters also become a DisjunctionNode, which needs a multi query
+  if (not RAW_PROJECTION or not projection or not issubclass(cls, ScopedModel) or
+      multiquery.applies(q)):
+    return False
+  for name in projection:
+    if "." in name or not re_public.match(name):
+      return False
+    prop = cls._properties.get(name)
+    if prop is not None and isinstance(prop, ndb.StructuredProperty):
+      return False
+  return True
+
+
+_generic_property = ndb.GenericProperty()
+
+
+# Decode a projected entity protobuf into the dict to_dict would give, using the declared property
+# of the class to convert each value and a GenericProperty for dynamic ones.
+def projected_view(cls, pb):
+  result = {}
+  for p in pb.property_list():
+    prop = cls._properties.get(p.name(), _generic_property)
+    result[p.name()] = _raw_value(prop, p)
+  result["Id"] = ndb.Key(reference=pb.key()).urlsafe()
+  return result
+
+
+# Like iter_page for raw_projection queries, the query runs on a connection that returns the entity
+# protobufs as they are.
+def iter_projection_page(self, cls, q, page_size, cursor, projection):
+  conn = datastore_rpc.Connection(adapter=datastore_rpc.IdentityAdapter())
+  options = datastore_query.QueryOptions(projection=tuple(projection), limit=page_size + 1,
+                                         batch_size=page_size + 1, start_cursor=cursor,
+                                         produce_cursors=True)
+  batcher = _raw_run(q, conn, options)
+  count = 0
+  more = False
+  position = None
+  batch = batcher.next_batch(datastore_query.Batcher.AT_LEAST_ONE)
+  while batch and not more:
+    for index, pb in enumerate(batch.results):
+      if count == page_size:
+        more = True
+        break
+      yield projected_view(cls, pb)
+      count += 1
+      position = (batch, index + 1)
+    if not more:
+      batch = batcher.next_batch(datastore_query.Batcher.AT_LEAST_ONE)
+  cursor = position[0].cursor(position[1]) if position else None
+  for k, v in page_headers(cursor, more).iteritems():
+    self.response.headers[k] = v
+
+
+# A canonical description of a query used as its cache key. Filters are compared after parsing so
+# equivalent filter strings share an entry, and the children of AND and OR are sorted.
+def canonical_filter(node):
+  if node is None:
+    return ""
+  if isinstance(node, ndb.query.ConjunctionNode):
+    return "AND({})".format(",".join(sorted(canonical_filter(n) for n in node)))
+  if isinstance(node, ndb.query.DisjunctionNode):
+    return "OR({})".format(",".join(sorted(canonical_filter(n) for n in node)))
+  return repr(node)
+
+
+def query_signature(q, orders, projection, page_size, cursor):
+  return repr((
+    namespace_manager.get_namespace(),
+    repr(q.ancestor),
+    canonical_filter(q.filters),
+    [o.strip() for o in orders],
+    sorted(projection or []),
+    int(page_size),
+    cursor or "",
+  ))
 
 
 # This validates the data see validation.template.json for an example.
@@ -488,11 +827,16 @@ def validate(cls_name, data):
       # TODO(doug): validate list, can't be empty list, must contain id like objects
       pass
   # run validation over remaining properties
-  if _validation:
-    validations = _validation.get(cls_name)
-    if not validations:
+  validation = _validation.get()
+  if validation:
+    if cls_name not in validation:
       raise AppError("Validation requires all valid models to be listed, use empty quote to skip.")
-    _validate(validations, data, acl_attributes)
+    check = validation[cls_name]
+    if check:
+      errors = []
+      check(data, "", errors, acl_attributes)
+      if errors:
+        raise AppError("; ".join(errors))
 
 # evaluate the attributes of your User Class for extra properties
 def getAttributes(item, exclude=[]):
@@ -514,6 +858,57 @@ def getAttributes(item, exclude=[]):
         attrs[name] = attr
   return attrs
 
+# Read cache
+# ----------
+# With CACHE enabled GET by id reads the serialized views from memcache, see restful/cache.py.
+def cache_ttl(kind):
+  return _config.CACHE_TTLS.get(kind.lower(), _config.CACHE_TTL)
+
+
+def can_read_acl(acl):
+  if is_admin():
+    return True
+  u = current_user()
+  return u is not None and u in acl
+
+
+def load_cache_views(keys):
+  return [m.cache_views() if m else None for m in ndb.get_multi(keys)]
+
+
+def cached_get_multi(keys):
+  return cache.get_multi(keys, can_read_acl, load_cache_views, cache_ttl)
+
+
+@ndb.transactional
+def _patch(key, data):
+  m = key.get(use_cache=False)
+  if m is None:
+    raise AppError("No {} with id {}.".format(key.kind(), key.id()))
+  # a separate instance keeps the old owners and admin properties for the checks in _pre_put_hook
+  previous = m.__class__._from_pb(m._to_pb())
+  reflective_update(m, data)
+  m._previous = previous
+  m._prefetched = True
+  m.put()
+  return m
+
+
+# Resolve the class used to write a model name, either one of the DEFINED_MODELS or a dynamic
+# ScopedExpando.
+def writable_model(model):
+  cls = None
+  if _config.DEFINED_MODELS:
+    cls = _config.DEFINED_MODELS.get(model)
+    if not cls and _config.RESTRICT_TO_DEFINED_MODELS:
+      raise RestrictedModelError
+    if cls:
+      model = cls.__name__
+  if not cls:
+    validate_modelname(model)
+    cls = dynamic_model(model)
+  return model, cls
+
 # This does all the simple restful handling that you would expect. There is a special catch for
 # /users/me which will look up your logged in id and return your information.
 class RestfulHandler(BaseHandler):
@@ -528,7 +923,7 @@ class RestfulHandler(BaseHandler):
         model = cls.__name__
     if not cls:
       validate_modelname(model)
-      cls = users if model == "users" else type(model, (ScopedExpando,), {})
+      cls = users if model == "users" else dynamic_model(model)
     logging.info("ID %s" % id)
     if id:
       me = False
@@ -540,23 +935,35 @@ class RestfulHandler(BaseHandler):
       if "," in id:
         ids = id.split(",")
         keys = [parse_id(i, model) for i in ids]
+        if _config.CACHE and model != "users":
+          return cached_get_multi(keys)
         results = ndb.get_multi(keys)
         return [m.to_dict() if m else m for m in results]
       key = parse_id(id, model)
-      m = key.get()
+      if _config.CACHE and model != "users":
+        result = cached_get_multi([key])[0]
+        if result is None:
+          raise AppError("No {} with id {}.".format(model, id))
+        return result
+      m = key.get_async()
+      attributes = None
+      if model == "users" and me:
+        # read the user attributes while the datastore get is in flight
+        u = config.get_current_user()
+        if u:
+          attributes = getAttributes(u)
+      m = m.get_result()
       if not m:
         if model == "users" and me:
           m = users()
           m.key = key
         else:
           raise AppError("No {} with id {}.".format(model, id))
-      if model == "users" and me:
-        u = config.get_current_user()
-        if u:
-          for k, v in getAttributes(u).items():
-            if k.startswith("_"):
-              k = "$" + k[1:]
-            setattr(m, k, v)
+      if attributes:
+        for k, v in attributes.items():
+          if k.startswith("_"):
+            k = "$" + k[1:]
+          setattr(m, k, v)
       return m.to_dict()
     else:
       return query(self, cls, *extra_filters)
@@ -580,7 +987,11 @@ class RestfulHandler(BaseHandler):
                        "user_id or me. User {} tried to modify user {}.".format(u, id))
       id = u.urlsafe()
     key = parse_id(id, model)
-    key.delete()
+    try:
+      key.delete()
+    finally:
+      # the post delete hook does not run when a pre delete hook fails
+      deleting().pop(key, None)
 
     return {}
 
@@ -594,18 +1005,11 @@ class RestfulHandler(BaseHandler):
       id = u.urlsafe()
       cls = users
     else:
-      cls = None
-      if _config.DEFINED_MODELS:
-        cls = _config.DEFINED_MODELS.get(model)
-        if not cls and _config.RESTRICT_TO_DEFINED_MODELS:
-          raise RestrictedModelError
-        if cls:
-          model = cls.__name__
-      if not cls:
-        validate_modelname(model)
-        cls = type(model, (ScopedExpando,), {})
+      model, cls = writable_model(model)
     data = parse_body(self)
     key = parse_id(id, model, data.get("Id"))
+    # fetch the previous version for the access checks while the body is validated and converted
+    previous = key.get_async() if key else None
     clean_data(data)
     validate(cls.__name__, data)
 
@@ -615,6 +1019,9 @@ class RestfulHandler(BaseHandler):
     if model != "users":
       if len(m.owners) == 0:
         m.owners.append(u)
+    if previous:
+      m._previous = previous.get_result()
+      m._prefetched = True
 
     m.put()
 
@@ -625,28 +1032,216 @@ class RestfulHandler(BaseHandler):
       raise BreakError()
     return m.to_dict()
 
+  # Update only the properties given in the body. The object is read, changed and written in one
+  # transaction, so owners, viewers and every other property not in the body are kept. The loaded
+  # object is handed to the put hooks as the previous version for the access and admin checks.
+  def partial_update(self, model, id):
+    model = model.lower()
+    u = current_user(required=True)
+    if model == "users":
+      if not (id == "me" or id == "" or id == u.urlsafe()):
+        raise AppError("Id must be the current " +
+                       "user_id or me. User {} tried to modify user {}.".format(u, id))
+      id = u.urlsafe()
+      cls = users
+    else:
+      model, cls = writable_model(model)
+    data = parse_body(self)
+    key = parse_id(id, model, data.get("Id"))
+    if not key:
+      raise AppError("Must provide an id.")
+    clean_data(data)
+    validate(cls.__name__, data)
+
+    m = _patch(key, data)
+    # the put hooks ran before the commit, clear anything cached from the old version since
+    for rpc in uncache_async(key):
+      rpc.get_result()
+
+    redirect = self.request.get("redirect")
+    if redirect:
+      self.redirect(redirect)
+      raise BreakError()
+    return m.to_dict()
+
+  # The index.yaml entries recorded by the query planner for a model, admin only.
+  def indexes(self, model):
+    if not is_admin():
+      raise AppError("Only admins can list the suggested indexes.")
+    model = model.lower()
+    cls = _config.DEFINED_MODELS.get(model) if _config.DEFINED_MODELS else None
+    kind = cls._get_kind() if cls else model
+    return {"kind": kind, "yaml": planner.suggested_indexes(kind)}
+
+  # Write the objects of a model matching the optional filter as newline delimited json, admin only.
+  # The response is sent when the handler returns, so an export ends after EXPORT_LIMIT objects or
+  # EXPORT_SECONDS and sets the More and Cursor headers to continue from.
+  def export(self, model):
+    if not is_admin():
+      raise AppError("Only admins can export a model.")
+    model = model.lower()
+    if model == "users":
+      cls = users
+    else:
+      model, cls = writable_model(model)
+    params = self.request.get("params")
+    if params:
+      params = json.loads(params)
+      cursor = params.get("cursor")
+      q = construct_query_from_json(cls, params.get("filter"), None)
+    else:
+      cursor = self.request.get("cursor")
+      q = construct_query_from_url_args(cls, self.request.get_all("filter"), [])
+    if _config.QUERY_PLANNER:
+      q = planner.plan(q, max_subqueries=_config.MAX_SUBQUERIES)
+    elif multiquery.applies(q):
+      # without the key order the planner adds ndb can not produce a cursor to resume from
+      raise AppError("Exporting with OR or IN filters needs the query planner.")
+    batch_size = int(self.request.get("batch_size", default_value=_config.EXPORT_BATCH_SIZE))
+    start = ndb.Cursor.from_websafe_string(cursor) if cursor else None
+    it = q.iter(batch_size=batch_size, start_cursor=start, produce_cursors=True)
+    out = self.response.out
+    deadline = time.time() + _config.EXPORT_SECONDS
+    count = 0
+    while it.has_next():
+      if count >= _config.EXPORT_LIMIT or time.time() > deadline:
+        break
+      out.write(json.dumps(it.next().to_dict(), default=json_extras))
+      out.write("\n")
+      count += 1
+    more = it.has_next()
+    cursor = it.cursor_after() if count else start
+    self.response.headers["Content-Type"] = "application/x-ndjson"
+    self.response.headers["More"] = "true" if more else "false"
+    if cursor:
+      self.response.headers["Cursor"] = cursor.urlsafe()
+    raise BreakError()
+
+  # Start importing an ndjson file uploaded through /api/files, admin only. The body names the blob
+  # as {"blob": "<Id from /api/files>"}.
+  def start_import(self, model):
+    # imported here because the importer uses this module
+    from tailbone.restful import importer
+    if not is_admin():
+      raise AppError("Only admins can import.")
+    # the chunks look the model up again by the name used in the url
+    model = model.lower()
+    importer.importable_model(model)
+    blob = parse_body(self).get("blob")
+    if not blob:
+      raise AppError("Must provide the blob to import.")
+    return importer.start(model, blob, current_user(required=True)).to_dict()
+
+  # The progress and errors of an import, given as ?job={Id}.
+  def import_progress(self, model):
+    from tailbone.restful import importer
+    if not is_admin():
+      raise AppError("Only admins can see imports.")
+    job_id = self.request.get("job")
+    if not job_id:
+      raise AppError("Must provide the import job.")
+    return importer.progress(job_id)
+
+  # Create or update a list of objects in one request. Every item is validated and checked
+  # separately, previous versions are fetched with a single get_multi and all valid items are
+  # written with one put_multi. The response lists the saved object or the error for each item.
+  def batch(self, model):
+    model = model.lower()
+    if model == "users":
+      raise AppError("Users can not be written in batches.")
+    u = current_user(required=True)
+    model, cls = writable_model(model)
+    items = parse_body(self)
+    if not isinstance(items, list):
+      raise AppError("Batch body must be a json list of objects.")
+    if len(items) > _config.BATCH_LIMIT:
+      raise AppError("Batch is limited to {} items.".format(_config.BATCH_LIMIT))
+    results = [None] * len(items)
+    pending = []
+    for i, data in enumerate(items):
+      try:
+        if not isinstance(data, dict):
+          raise AppError("Batch items must be json objects.")
+        key = parse_id(None, model, data.get("Id"))
+        clean_data(data)
+        validate(cls.__name__, data)
+        m = reflective_create(cls, data)
+        if key:
+          m.key = key
+        if len(m.owners) == 0:
+          m.owners.append(u)
+        pending.append((i, m))
+      except AppError as e:
+        results[i] = {"error": e.__class__.__name__, "message": e.message}
+      except api.datastore_errors.Error as e:
+        # typed properties of defined models reject values when they are set
+        results[i] = {"error": e.__class__.__name__, "message": str(e)}
+    keyed = [m for i, m in pending if m.key]
+    for m, previous in zip(keyed, ndb.get_multi([m.key for m in keyed])):
+      m._previous = previous
+      m._prefetched = True
+    writable = []
+    for i, m in pending:
+      try:
+        # run the access checks up front, a hook that raises inside put_multi_async fails the
+        # whole call. put_multi_async runs the hook again, which is cheap and changes nothing
+        # more since _previous is already fetched and the admin properties already reset.
+        m._pre_put_hook()
+        writable.append((i, m))
+      except (AppError, LoginError) as e:
+        results[i] = {"error": e.__class__.__name__, "message": e.message}
+    futures = ndb.put_multi_async([m for i, m in writable])
+    for (i, m), future in zip(writable, futures):
+      try:
+        future.get_result()
+        results[i] = m.to_dict()
+      except (api.datastore_errors.BadArgumentError,
+              api.datastore_errors.BadRequestError,
+              api.datastore_errors.BadValueError) as e:
+        results[i] = {"error": e.__class__.__name__, "message": str(e)}
+    return results
+
   # Metadata including the count in the response header
   def head(self, model, id):
+    model = model.lower()
+    metadata = {}
     if _config.METADATA:
-      model = model.lower()
       validate_modelname(model)
-      metadata = {
-        "total": counter.get_count(model)
-      }
-      self.response.headers["Metadata"] = json.dumps(metadata)
+      metadata["total"] = counter.get_count(model)
+      metadata["counter"] = counter.contention(model)
+    if _config.CACHE:
+      validate_modelname(model)
+      metadata["cache"] = cache.stats(model)
+    if _config.AGGREGATES:
+      aggregates = visible_aggregates(model)
+      if aggregates:
+        metadata["aggregates"] = aggregates
+    if metadata:
+      self.response.headers["Metadata"] = json.dumps(metadata, default=json_extras)
 
   @as_json
   def get(self, model, id):
+    if id == "_aggregate":
+      return visible_aggregates(model.lower())
+    if id == "_indexes":
+      return self.indexes(model)
+    if id == "_export":
+      return self.export(model)
+    if id == "_import":
+      return self.import_progress(model)
     return self._get(model, id)
 
   @as_json
-  def post(self, *args):
-    return self.set_or_create(*args)
+  def post(self, model, id):
+    if id == "_batch":
+      return self.batch(model)
+    if id == "_import":
+      return self.start_import(model)
+    return self.set_or_create(model, id)
 
   @as_json
   def patch(self, *args):
-    # TODO: implement this differently to do partial update
-    return self.set_or_create(*args)
+    return self.partial_update(*args)
 
   @as_json
   def put(self, *args):
@@ -657,10 +1252,28 @@ class RestfulHandler(BaseHandler):
     return self._delete(*args)
 
 
+# The aggregates of a model the current user may see, those over private properties are only shown
+# to admins.
+def visible_aggregates(model):
+  cls = _config.DEFINED_MODELS.get(model) if _config.DEFINED_MODELS else None
+  if _config.DEFINED_MODELS and not cls and _config.RESTRICT_TO_DEFINED_MODELS:
+    raise RestrictedModelError
+  if not cls:
+    validate_modelname(model)
+  kind = (cls._get_kind() if cls else model).lower()
+  specs = _config.AGGREGATES.get(kind, [])
+  if not is_admin():
+    specs = [spec for spec in specs if re_public.match(spec["group"]) and
+             (not spec.get("value") or re_public.match(spec["value"]))]
+  return aggregate.read(kind, specs)
+
+
 def get_model(urlsafekey):
   key = ndb.Key(urlsafe=urlsafekey)
   # dynamic class defined if doesn't exists for reflective creation later
-  type(key.kind(), (ScopedExpando,), {})
+  registered = ndb.Model._kind_map.get(key.kind())
+  if registered is None or not issubclass(registered, HookedModel):
+    dynamic_model(key.kind())
   m = key.get()
   if not key:
     raise AppError("Model {} does not exists.".format(urlsafekey))
@@ -668,25 +1281,83 @@ def get_model(urlsafekey):
 
 # Load an optional validation.json
 # --------------------------------
+# Patterns that match any text, and patterns whose result follows from the type of a non string
+# value, so those values are never serialized to be matched.
+# With a "$" the pattern rejects text that holds a newline, so only these are skipped.
+_match_all = frozenset([".*", "^.*"])
+_native_patterns = {
+  r"^[-]?[0-9]+$": (int, long),
+  r"^\{.*\}$": dict,
+  r"^\[.*\]$": list,
+}
+
+
+# The json text a regex is matched against for a value that is not a string.
+def _validation_text(value):
+  if isinstance(value, bool):
+    return "true" if value else "false"
+  if isinstance(value, (int, long)):
+    return str(value)
+  if value is None:
+    return "null"
+  return json.dumps(value)
+
+
+def _pattern_check(pattern):
+  regex = re.compile(pattern)
+  native = _native_patterns.get(pattern)
+
+  def check(value, path, errors, ignored=()):
+    if isinstance(value, basestring):
+      text = value
+    elif native and isinstance(value, native) and not isinstance(value, bool):
+      return
+    else:
+      text = _validation_text(value)
+    if not regex.match(text):
+      errors.append("Validator '{}' does not match '{}' at '{}'".format(pattern, text, path))
+  return check
+
+
+def _object_check(checks):
+  def check(value, path, errors, ignored=()):
+    if not isinstance(value, dict):
+      errors.append("Expected an object at '{}'".format(path))
+      return
+    for name, val in value.iteritems():
+      if name in ignored:
+        continue
+      child = "{}.{}".format(path, name) if path else name
+      if name not in checks:
+        errors.append("No validator for '{}'".format(child))
+        continue
+      c = checks[name]
+      if c:
+        c(val, child, errors)
+  return check
+
+
+# Turn a validator from validation.json into a function of (value, path, errors, ignored) that
+# appends a message to errors for every failure, or None when there is nothing to check.
+def compile_validator(target):
+  if isinstance(target, basestring):
+    if target == "" or target in _match_all:
+      return None
+    return _pattern_check(target)
+  if isinstance(target, dict):
+    return _object_check(dict((k, compile_validator(v)) for k, v in target.iteritems()))
+  logging.error("validation.json invalid, target is {}".format(target))
+  raise ValueError("Invalid target type")
+
+
 def compile_validation(target):
   if not isinstance(target, dict):
     logging.error("validation.json invalid, target is {}".format(target))
     raise ValueError("Invalid target type")
-  for k, v in target.iteritems():
-    if type(v) in [str, unicode]:
-      target[k] = re.compile(v)
-    else:
-      target[k] = compile_validation(v)
-  return target
-
-_validation = None
-try:
-  with open("validation.json") as f:
-    _validation = compile_validation(json.load(f))
-except ValueError:
-  logging.error("validation.json is not a valid json document.")
-except IOError:
-  logging.info("validation.json doesn't exist no model validation will be performed.")
+  return dict((k, compile_validator(v)) for k, v in target.iteritems())
+
+_validation = ReloadableConfig("validation.json", compile_validation,
+                               "validation.json doesn't exist no model validation will be performed.")
 
 
 EXPORTED_JAVASCRIPT = compile_js([
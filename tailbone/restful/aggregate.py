@@ -0,0 +1,262 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+
+from google.appengine.api import datastore
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+
+ID_TEMPLATE = '{}|{}|{}|{}'
+
+
+class TailboneAggregate(ndb.Model):
+  """Count, sum, min and max of the objects of a kind sharing one group value."""
+  kind = ndb.StringProperty()
+  group = ndb.StringProperty()
+  field = ndb.StringProperty()
+  value = ndb.GenericProperty(indexed=False)
+  count = ndb.IntegerProperty(default=0, indexed=False)
+  sum = ndb.FloatProperty(default=0.0, indexed=False)
+  min = ndb.FloatProperty(indexed=False)
+  max = ndb.FloatProperty(indexed=False)
+
+
+def _json_value(obj):
+  if isinstance(obj, ndb.Key):
+    return obj.urlsafe()
+  if hasattr(obj, "isoformat"):
+    return obj.isoformat()
+  return repr(obj)
+
+
+def _aggregate_id(kind, spec, value):
+  digest = hashlib.sha1(json.dumps(value, default=_json_value, sort_keys=True)).hexdigest()
+  return ID_TEMPLATE.format(kind, spec["group"], spec.get("value", ""), digest)
+
+
+def _contributions(spec, m):
+  """The group values of an object and the number it adds to their sum, min and max."""
+  if m is None:
+    return [], None
+  groups = getattr(m, spec["group"], None)
+  if groups is None:
+    return [], None
+  if not isinstance(groups, list):
+    groups = [groups]
+  number = getattr(m, spec["value"], None) if spec.get("value") else None
+  if isinstance(number, bool) or not isinstance(number, (int, long, float)):
+    number = None
+  unique = []
+  for group in groups:
+    if group not in unique:
+      unique.append(group)
+  return unique, number
+
+
+def changes(kind, specs, old, new):
+  """The changes a write makes to the aggregates of its kind.
+
+  Args:
+    kind: The lowercase model name.
+    specs: The aggregates configured for the kind, a list of dicts with the
+      "group" property and an optional numeric "value" property.
+    old: The object before the write, or None when it was created.
+    new: The object after the write, or None when it was deleted.
+
+  Returns:
+    A list of (id, kind, spec, group value, count delta, sum delta, added
+      numbers, removed numbers) tuples, unchanged groups are left out.
+  """
+  result = []
+  for spec in specs:
+    old_groups, old_number = _contributions(spec, old)
+    new_groups, new_number = _contributions(spec, new)
+    for group in old_groups:
+      if group in new_groups:
+        if old_number != new_number:
+          # same group, only the number moved
+          result.append((_aggregate_id(kind, spec, group), kind, spec, group, 0,
+                         (new_number or 0) - (old_number or 0), _numbers(new_number),
+                         _numbers(old_number)))
+        continue
+      result.append((_aggregate_id(kind, spec, group), kind, spec, group, -1,
+                     -(old_number or 0), [], _numbers(old_number)))
+    for group in new_groups:
+      if group not in old_groups:
+        result.append((_aggregate_id(kind, spec, group), kind, spec, group, 1,
+                       new_number or 0, _numbers(new_number), []))
+  return result
+
+
+def _numbers(number):
+  return [] if number is None else [number]
+
+
+def merge(pending):
+  """Combine the changes of many writes into one change per aggregate."""
+  merged = {}
+  order = []
+  for change in pending:
+    aggregate_id, kind, spec, group, count, total, added, removed = change
+    current = merged.get(aggregate_id)
+    if current is None:
+      merged[aggregate_id] = [aggregate_id, kind, spec, group, count, total, list(added),
+                              list(removed)]
+      order.append(aggregate_id)
+    else:
+      current[4] += count
+      current[5] += total
+      current[6].extend(added)
+      current[7].extend(removed)
+  return [tuple(merged[aggregate_id]) for aggregate_id in order]
+
+
+def update_many_async(kind, specs, pairs):
+  """Apply the changes of a list of (old, new) writes with one transaction per aggregate.
+
+  Returns:
+    A future, or None when nothing changed.
+  """
+  pending = merge([change for old, new in pairs for change in changes(kind, specs, old, new)])
+  if not pending:
+    return None
+  return _apply_all_async(pending)
+
+
+def update_async(kind, specs, old, new):
+  """Apply the changes of a write to the aggregates of its kind.
+
+  Every aggregate is updated in its own transaction. Inside a transaction, such
+  as a PATCH, the updates run from a transactional task once it commits.
+
+  Returns:
+    A future, or None when nothing changed or the update was deferred.
+  """
+  pending = changes(kind, specs, old, new)
+  if not pending:
+    return None
+  if ndb.in_transaction():
+    deferred.defer(apply_changes, pending, _transactional=True)
+    return None
+  return _apply_all_async(pending)
+
+
+@ndb.tasklet
+def _apply_all_async(pending):
+  yield [_apply_async(*change) for change in pending]
+
+
+def apply_changes(pending):
+  """Apply a list of changes from a deferred task."""
+  _apply_all_async(pending).get_result()
+
+
+@ndb.transactional_tasklet
+def _apply_async(aggregate_id, kind, spec, group, count, total, added, removed):
+  a = yield TailboneAggregate.get_by_id_async(aggregate_id)
+  if a is None:
+    a = TailboneAggregate(id=aggregate_id, kind=kind, group=spec["group"],
+                          field=spec.get("value", ""), value=group)
+  a.count += count
+  a.sum += total
+  if a.count <= 0:
+    yield a.key.delete_async()
+    return
+  if added:
+    a.min = min(added) if a.min is None else min(a.min, min(added))
+    a.max = max(added) if a.max is None else max(a.max, max(added))
+  if removed and (a.min in removed or a.max in removed):
+    # the extreme left the group, the next one can only be found by reading the group again
+    deferred.defer(recompute, aggregate_id, _transactional=True)
+  yield a.put_async()
+
+
+def recompute(aggregate_id):
+  """Read every object of a group to find its min and max again."""
+  a = TailboneAggregate.get_by_id(aggregate_id)
+  if a is None or not a.field:
+    return
+  q = ndb.Query(kind=_stored_kind(a)).filter(ndb.GenericProperty(a.group) == a.value)
+  numbers = []
+  for keys in _batches(q.iter(keys_only=True), 500):
+    for entity in datastore.Get([key.to_old_key() for key in keys]):
+      number = entity.get(a.field) if entity else None
+      if isinstance(number, (int, long, float)) and not isinstance(number, bool):
+        numbers.append(number)
+  if numbers:
+    _set_extremes(aggregate_id, min(numbers), max(numbers))
+  else:
+    _set_extremes(aggregate_id, None, None)
+
+
+def _stored_kind(a):
+  # the kind is stored lowercase, defined models may be registered with another case
+  for kind in ndb.Model._kind_map:
+    if kind.lower() == a.kind:
+      return kind
+  return a.kind
+
+
+def _batches(iterable, size):
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+@ndb.transactional
+def _set_extremes(aggregate_id, smallest, largest):
+  a = TailboneAggregate.get_by_id(aggregate_id)
+  if a is None:
+    return
+  a.min = smallest
+  a.max = largest
+  a.put()
+
+
+def read(kind, specs):
+  """The current aggregates of a kind.
+
+  Args:
+    kind: The lowercase model name.
+    specs: The aggregates to read, see changes.
+
+  Returns:
+    A list with a dict for every spec, holding its "group" and "value"
+      property names and a "groups" list of {"group", "count", "sum", "min",
+      "max"} dicts.
+  """
+  queries = []
+  for spec in specs:
+    q = TailboneAggregate.query(TailboneAggregate.kind == kind,
+                                TailboneAggregate.group == spec["group"],
+                                TailboneAggregate.field == spec.get("value", ""))
+    queries.append(q.fetch_async())
+  result = []
+  for spec, q in zip(specs, queries):
+    groups = []
+    for a in q.get_result():
+      group = {"group": a.value, "count": a.count}
+      if a.field:
+        group.update({"sum": a.sum, "min": a.min, "max": a.max})
+      groups.append(group)
+    result.append({"group": spec["group"], "value": spec.get("value"), "groups": groups})
+  return result
@@ -0,0 +1,196 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+
+
+PREFIX = "tailbone-restful-cache-"
+OWNER_TEMPLATE = "owner-{}"
+PUBLIC_TEMPLATE = "public-{}"
+STATS_TEMPLATE = "{}-{}"
+GENERATION_TEMPLATE = "generation-{}"
+QUERY_TEMPLATE = "query-{}-{}-{}"
+# placeholder an entry holds while it is loaded, a write in between deletes it and the fill fails
+FILLING = "tailbone-restful-cache-filling"
+FILL_SECONDS = 30
+
+
+def _entry_names(urlsafe):
+  return OWNER_TEMPLATE.format(urlsafe), PUBLIC_TEMPLATE.format(urlsafe)
+
+
+def get_multi(keys, can_read, load, ttl):
+  """Read through memcache to the serialized views of a list of keys.
+
+  Every object is cached as two entries. The owner entry holds the owners and
+  viewers of the object plus its full view, the public entry holds only the
+  public properties. Missing entries are filled with cas over a placeholder, so
+  a load that races a write never caches the old views.
+
+  Args:
+    keys: The ndb.Key values to look up.
+    can_read: Callable taking a list of owners and viewers, returns True if the
+      current user may see the owner view.
+    load: Callable taking a list of keys, returns a list with a tuple of
+      (owners and viewers, owner view, public view) or None for every key.
+    ttl: Callable taking a kind, returns the seconds its entries live.
+
+  Returns:
+    A list with the view the current user may see, or None, for every key.
+  """
+  names = []
+  for key in keys:
+    names.extend(_entry_names(key.urlsafe()))
+  client = memcache.Client()
+  cached = client.get_multi(names, key_prefix=PREFIX)
+  results = [None] * len(keys)
+  missing = []
+  for i, key in enumerate(keys):
+    owner_name, public_name = _entry_names(key.urlsafe())
+    owner = cached.get(owner_name)
+    if owner is None or owner == FILLING:
+      missing.append(i)
+      continue
+    acl, view = owner
+    if not can_read(acl):
+      view = cached.get(public_name)
+      if view is None or view == FILLING:
+        missing.append(i)
+        continue
+    results[i] = view
+  if missing:
+    fill_names = []
+    for i in missing:
+      fill_names.extend(_entry_names(keys[i].urlsafe()))
+    client.add_multi(dict((name, FILLING) for name in fill_names),
+                     time=FILL_SECONDS, key_prefix=PREFIX)
+    # only placeholders still there when the load is done get filled
+    filling = client.get_multi(fill_names, key_prefix=PREFIX, for_cas=True)
+    entries = {}
+    for i, loaded in zip(missing, load([keys[i] for i in missing])):
+      if loaded is None:
+        continue
+      acl, owner_view, public_view = loaded
+      results[i] = owner_view if can_read(acl) else public_view
+      kind = keys[i].kind()
+      owner_name, public_name = _entry_names(keys[i].urlsafe())
+      mapping = entries.setdefault(kind, {})
+      for name, value in ((owner_name, (acl, owner_view)), (public_name, public_view)):
+        if filling.get(name) == FILLING:
+          mapping[name] = value
+    for kind, mapping in entries.iteritems():
+      if mapping:
+        client.cas_multi(mapping, time=ttl(kind), key_prefix=PREFIX)
+  _record(keys, len(keys) - len(missing), len(missing))
+  return results
+
+
+def _record(keys, hits, misses):
+  """Add to the hit and miss counters of the kind, without waiting on memcache."""
+  if not keys:
+    return
+  kind = keys[0].kind().lower()
+  memcache.Client().offset_multi_async({
+    STATS_TEMPLATE.format(kind, "hits"): hits,
+    STATS_TEMPLATE.format(kind, "misses"): misses,
+  }, key_prefix=PREFIX, initial_value=0)
+
+
+def invalidate_async(keys):
+  """Remove the cached views of a list of keys.
+
+  Args:
+    keys: The ndb.Key values that were written or deleted.
+
+  Returns:
+    An rpc whose get_result completes when the entries are gone.
+
+  Deleting a placeholder also makes the cas of a fill in progress fail.
+  """
+  names = []
+  for key in keys:
+    names.extend(_entry_names(key.urlsafe()))
+  return memcache.Client().delete_multi_async(names, key_prefix=PREFIX)
+
+
+def stats(kind):
+  """The number of cache hits and misses recorded for a kind.
+
+  Args:
+    kind: The kind name, case insensitive.
+
+  Returns:
+    A dict with the "hits" and "misses" counts.
+  """
+  kind = kind.lower()
+  names = [STATS_TEMPLATE.format(kind, "hits"), STATS_TEMPLATE.format(kind, "misses")]
+  values = memcache.get_multi(names, key_prefix=PREFIX)
+  return {
+    "hits": values.get(names[0], 0),
+    "misses": values.get(names[1], 0),
+  }
+
+
+def _initial_generation():
+  # milliseconds so a generation lost from memcache restarts above any value it held recently
+  return int(time.time() * 1000)
+
+
+def query_name(kind, signature):
+  """The cache entry name for a query, bound to the current generation of its kind.
+
+  Read the name before running the query so that a write landing while the
+  query runs leaves its result under an outdated generation.
+
+  Args:
+    kind: The kind being queried.
+    signature: A canonical string describing the filters, orders, projection,
+      page size and cursor of the query.
+
+  Returns:
+    A memcache key name.
+  """
+  name = PREFIX + GENERATION_TEMPLATE.format(kind)
+  generation = memcache.get(name)
+  if generation is None:
+    memcache.add(name, _initial_generation())
+    generation = memcache.get(name)
+  return QUERY_TEMPLATE.format(kind, generation, hashlib.sha1(signature).hexdigest())
+
+
+def get_query(name):
+  """A cached query result or None, see query_name."""
+  return memcache.get(PREFIX + name)
+
+
+def set_query(name, value, ttl):
+  """Store a query result for ttl seconds, see query_name."""
+  memcache.set(PREFIX + name, value, time=ttl)
+
+
+def bump_generation_async(kind):
+  """Orphan every cached query of a kind by advancing its generation.
+
+  Args:
+    kind: The kind that was written or deleted.
+
+  Returns:
+    An rpc whose get_result completes when the generation has moved on.
+  """
+  return memcache.Client().offset_multi_async(
+      {GENERATION_TEMPLATE.format(kind): 1}, key_prefix=PREFIX,
+      initial_value=_initial_generation())
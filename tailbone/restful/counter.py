@@ -1,15 +1,60 @@
+import datetime
+import logging
 import random
+import sys
+import time
 
+from google.appengine.api import datastore_errors
+from google.appengine.api import lib_config
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
+from tailbone import defer_once
+
 
 SHARD_KEY_TEMPLATE = 'shard-{}-{:d}'
+PREFIX = 'tailbone-counter-'
+PENDING_TEMPLATE = 'pending-{}-{}'
+FRESH_TEMPLATE = 'fresh-{}'
+STATS_TEMPLATE = 'stats-{}-{:d}-{}'
+RESIZE_TEMPLATE = 'resize-{}-{:d}'
+
+
+class _ConfigDefaults(object):
+  # accumulate changes in memcache and write them to the shards from a task, a memcache eviction
+  # before the flush loses the buffered changes
+  BUFFERED = False
+  # seconds between flushes of the buffered changes of a counter
+  FLUSH_DELAY = 10
+  # seconds a process reuses the shard count it read for a counter
+  CONFIG_TTL = 60
+  # seconds a cached total is served before it is recomputed in the background
+  COUNT_TTL = 60
+  # seconds over which writes, retries and commit latency are tracked for each counter
+  STATS_WINDOW = 300
+  # fraction of shard transactions that retried or failed above which the shard count doubles
+  CONTENTION_THRESHOLD = 0.05
+  # writes needed in a window before its contention rate is trusted
+  CONTENTION_MIN_WRITES = 20
+  # counters with fewer writes than this over the last two windows are halved down to MIN_SHARDS
+  COLD_WRITES = 10
+  MIN_SHARDS = 1
+  MAX_SHARDS = 200
+
+_config = lib_config.register('tailboneCounter', _ConfigDefaults.__dict__)
+
+# name -> (num_shards, expiry time) for this process
+_shard_counts = {}
 
 
 class TailboneGeneralCounterShardConfig(ndb.Model):
   """Tracks the number of shards for each named counter."""
   num_shards = ndb.IntegerProperty(default=20)
+  # shards that may still hold counts after compaction lowered num_shards, 0 when none
+  num_read_shards = ndb.IntegerProperty(default=0)
+  compacted = ndb.DateTimeProperty()
 
   @classmethod
   def all_keys(cls, name):
@@ -23,8 +68,9 @@ class TailboneGeneralCounterShardConfig(ndb.Model):
         counter shards that could exist.
     """
     config = cls.get_or_insert(name)
+    num_shards = max(config.num_shards, config.num_read_shards)
     shard_key_strings = [SHARD_KEY_TEMPLATE.format(name, index)
-                         for index in range(config.num_shards)]
+                         for index in range(num_shards)]
     return [ndb.Key(TailboneGeneralCounterShard, shard_key_string)
             for shard_key_string in shard_key_strings]
 
@@ -37,6 +83,9 @@ class TailboneGeneralCounterShard(ndb.Model):
 def get_count(name):
   """Retrieve the value for a given sharded counter.
 
+  A cached total older than COUNT_TTL is still returned, and one request
+  schedules a task to recompute it.
+
   Args:
     name: The name of the counter.
 
@@ -44,46 +93,195 @@ def get_count(name):
     Integer; the cumulative count of all sharded counters for the given
       counter name.
   """
-  total = memcache.get(name)
+  fresh = PREFIX + FRESH_TEMPLATE.format(name)
+  values = memcache.get_multi([name, fresh])
+  total = values.get(name)
   if total is None:
-    total = 0
-    all_keys = TailboneGeneralCounterShardConfig.all_keys(name)
-    for counter in ndb.get_multi(all_keys):
-      if counter is not None:
-        total += counter.count
-    memcache.add(name, total, 60)
+    return recount(name)
+  if fresh not in values and memcache.add(fresh, True, _config.COUNT_TTL):
+    try:
+      deferred.defer(recount, name)
+    except taskqueue.Error:
+      logging.exception("Could not schedule a recount of %s.", name)
   return total
 
 
-def decrement(name):
-  """Decrement the value for a given sharded counter.
+def recount(name):
+  """Sum the shards and buffered changes of a counter and cache the total.
+
+  Args:
+    name: The name of the counter.
+
+  Returns:
+    The total.
+  """
+  total = _pending(name)[2]
+  all_keys = TailboneGeneralCounterShardConfig.all_keys(name)
+  for counter in ndb.get_multi(all_keys):
+    if counter is not None:
+      total += counter.count
+  memcache.set(name, total)
+  # the marker expires on its own so the first read after COUNT_TTL revalidates
+  memcache.set(PREFIX + FRESH_TEMPLATE.format(name), True, _config.COUNT_TTL)
+  if contention(name)["writes"] < _config.COLD_WRITES:
+    _schedule_resize(name, compact)
+  return total
+
+
+def contention(name):
+  """The shard count and write contention of a counter over the last two STATS_WINDOWs.
+
+  Args:
+    name: The name of the counter.
+
+  Returns:
+    A dict with the "shards" in use, the "writes", the "retries" of their
+      transactions, the "rate" of retries per write and the average commit
+      "latency" in milliseconds.
+  """
+  window = int(time.time() / _config.STATS_WINDOW)
+  stats = ("writes", "retries", "latency")
+  names = [STATS_TEMPLATE.format(name, w, stat) for w in (window - 1, window) for stat in stats]
+  values = memcache.get_multi(names, key_prefix=PREFIX)
+  totals = dict((stat, sum(values.get(STATS_TEMPLATE.format(name, w, stat), 0)
+                           for w in (window - 1, window)))
+                for stat in stats)
+  writes = totals["writes"]
+  return {
+    "shards": _num_shards_async(name).get_result(),
+    "writes": writes,
+    "retries": totals["retries"],
+    "rate": float(totals["retries"]) / writes if writes else 0.0,
+    "latency": totals["latency"] / writes if writes else 0,
+  }
+
+
+@ndb.tasklet
+def _record_async(name, num_shards, retries, latency):
+  """Adds a shard transaction to the stats of the current window, doubles hot counters.
+
+  Args:
+    name: The name of the counter.
+    num_shards: The shard count the transaction picked from.
+    retries: How many times the transaction was retried, or failed.
+    latency: Seconds from the first attempt to the commit.
+  """
+  window = int(time.time() / _config.STATS_WINDOW)
+  context = ndb.get_context()
+  writes, retried, _ = yield (
+      context.memcache_incr(PREFIX + STATS_TEMPLATE.format(name, window, "writes"), 1,
+                            initial_value=0),
+      context.memcache_incr(PREFIX + STATS_TEMPLATE.format(name, window, "retries"), retries,
+                            initial_value=0),
+      context.memcache_incr(PREFIX + STATS_TEMPLATE.format(name, window, "latency"),
+                            int(latency * 1000), initial_value=0))
+  if (writes >= _config.CONTENTION_MIN_WRITES and num_shards < _config.MAX_SHARDS and
+      retried > writes * _config.CONTENTION_THRESHOLD):
+    _schedule_resize(name, grow)
+
+
+def _schedule_resize(name, resize):
+  """Runs grow or compact for a counter in a task, at most once per STATS_WINDOW.
+
+  Every write to a hot counter asks for a grow, the process remembers the
+  window so only the first one costs a taskqueue call.
+  """
+  defer_once("tailbone-counter-{}-{}".format(resize.__name__, name), _config.STATS_WINDOW,
+             resize, name)
+
+
+def grow(name):
+  """Double the shards of a contended counter, up to MAX_SHARDS.
 
   Args:
     name: The name of the counter.
   """
   config = TailboneGeneralCounterShardConfig.get_or_insert(name)
-  _decrement(name, config.num_shards)
+  num_shards = min(config.num_shards * 2, _config.MAX_SHARDS)
+  logging.info("Growing counter %s from %d to %d shards.", name, config.num_shards, num_shards)
+  increase_shards(name, num_shards)
+
+
+def compact(name):
+  """Halve the shards of a cold counter, down to MIN_SHARDS.
+
+  Writers keep using a cached shard count for up to CONFIG_TTL seconds, so the
+  first call only lowers num_shards and remembers the old count as
+  num_read_shards. A call made CONFIG_TTL later folds the counts of the unused
+  shards into the remaining ones.
+
+  Args:
+    name: The name of the counter.
+  """
+  config = TailboneGeneralCounterShardConfig.get_or_insert(name)
+  if config.num_read_shards and config.num_read_shards <= config.num_shards:
+    # a grow since the compaction started covers the old shards again
+    _finish_compaction(name)
+  elif config.num_read_shards > config.num_shards:
+    settled = config.compacted + datetime.timedelta(seconds=_config.CONFIG_TTL)
+    if settled > datetime.datetime.now():
+      return
+    for index in range(config.num_shards, config.num_read_shards):
+      _fold(name, index, index % config.num_shards)
+    _finish_compaction(name)
+  elif config.num_shards > _config.MIN_SHARDS:
+    _lower_shards(name, max(config.num_shards / 2, _config.MIN_SHARDS))
 
 
 @ndb.transactional
-def _decrement(name, num_shards):
-  """Transactional helper to decrement the value for a given sharded counter.
+def _lower_shards(name, num_shards):
+  config = TailboneGeneralCounterShardConfig.get_or_insert(name)
+  if config.num_read_shards or config.num_shards <= num_shards:
+    return
+  logging.info("Compacting counter %s from %d to %d shards.", name, config.num_shards, num_shards)
+  config.num_read_shards = config.num_shards
+  config.num_shards = num_shards
+  config.compacted = datetime.datetime.now()
+  config.put()
+  _shard_counts.pop(name, None)
+
+
+@ndb.transactional(xg=True)
+def _fold(name, source_index, target_index):
+  source_key, target_key = [
+      ndb.Key(TailboneGeneralCounterShard, SHARD_KEY_TEMPLATE.format(name, index))
+      for index in (source_index, target_index)]
+  source, target = ndb.get_multi([source_key, target_key])
+  if source is None:
+    return
+  if target is None:
+    target = TailboneGeneralCounterShard(key=target_key)
+  target.count += source.count
+  target.put()
+  source.key.delete()
+
+
+@ndb.transactional
+def _finish_compaction(name):
+  config = TailboneGeneralCounterShardConfig.get_or_insert(name)
+  config.num_read_shards = 0
+  config.put()
+
 
-  Also takes a number of shards to determine which shard will be used.
+def decrement(name):
+  """Decrement the value for a given sharded counter.
 
   Args:
     name: The name of the counter.
-    num_shards: How many shards to use.
   """
-  index = random.randint(0, num_shards - 1)
-  shard_key_string = SHARD_KEY_TEMPLATE.format(name, index)
-  counter = TailboneGeneralCounterShard.get_by_id(shard_key_string)
-  if counter is None:
-    counter = TailboneGeneralCounterShard(id=shard_key_string)
-  counter.count -= 1
-  counter.put()
-  # Memcache increment does nothing if the name is not a key in memcache
-  memcache.decr(name)
+  decrement_async(name).get_result()
+
+
+def decrement_async(name):
+  """Asynchronously decrement the value for a given sharded counter.
+
+  Args:
+    name: The name of the counter.
+
+  Returns:
+    A future that completes when the shard has been updated.
+  """
+  return _change_async(name, -1)
 
 
 def increment(name):
@@ -92,29 +290,183 @@ def increment(name):
   Args:
     name: The name of the counter.
   """
-  config = TailboneGeneralCounterShardConfig.get_or_insert(name)
-  _increment(name, config.num_shards)
+  increment_async(name).get_result()
 
 
-@ndb.transactional
-def _increment(name, num_shards):
-  """Transactional helper to increment the value for a given sharded counter.
+def increment_async(name):
+  """Asynchronously increment the value for a given sharded counter.
+
+  Args:
+    name: The name of the counter.
+
+  Returns:
+    A future that completes when the shard has been updated.
+  """
+  return _change_async(name, 1)
+
+
+def add_async(name, delta):
+  """Asynchronously add any amount to a given sharded counter, used for bulk changes.
+
+  Args:
+    name: The name of the counter.
+    delta: Amount to add to the counter, may be negative.
+
+  Returns:
+    A future that completes when the shard has been updated.
+  """
+  return _change_async(name, delta)
+
+
+@ndb.tasklet
+def _change_async(name, delta):
+  """Applies delta to one random shard, or buffers it when BUFFERED is set.
+
+  Inside a caller's transaction the change is deferred with it, the shard
+  transaction can not nest.
+
+  Args:
+    name: The name of the counter.
+    delta: Amount to add to the counter, may be negative.
+  """
+  if _config.BUFFERED:
+    yield _buffer_async(name, delta)
+    return
+  if ndb.in_transaction():
+    deferred.defer(apply_change, name, delta, _transactional=True)
+    return
+  num_shards = yield _num_shards_async(name)
+  yield _change_shard_async(name, num_shards, delta)
+
+
+def apply_change(name, delta):
+  """Apply a change deferred from a transaction."""
+  _change_async(name, delta).get_result()
+
+
+@ndb.tasklet
+def _num_shards_async(name):
+  """The shard count of a counter, read at most once per CONFIG_TTL by a process.
 
-  Also takes a number of shards to determine which shard will be used.
+  Args:
+    name: The name of the counter.
+  """
+  cached = _shard_counts.get(name)
+  if cached and cached[1] > time.time():
+    raise ndb.Return(cached[0])
+  config = yield TailboneGeneralCounterShardConfig.get_or_insert_async(name)
+  _shard_counts[name] = (config.num_shards, time.time() + _config.CONFIG_TTL)
+  raise ndb.Return(config.num_shards)
+
+
+def _pending_names(name):
+  return PENDING_TEMPLATE.format(name, 'up'), PENDING_TEMPLATE.format(name, 'down')
+
+
+def _pending(name):
+  """The buffered changes of a counter as (increments, decrements, net)."""
+  up, down = _pending_names(name)
+  values = memcache.get_multi([up, down], key_prefix=PREFIX)
+  ups, downs = values.get(up, 0), values.get(down, 0)
+  return ups, downs, ups - downs
+
+
+@ndb.tasklet
+def _buffer_async(name, delta):
+  """Adds delta to the buffered changes and the cached total, then schedules a flush.
+
+  Memcache values can not go below zero so increments and decrements are kept
+  apart and netted when flushing.
+
+  Args:
+    name: The name of the counter.
+    delta: Amount to add to the counter, may be negative.
+  """
+  up, down = _pending_names(name)
+  context = ndb.get_context()
+  if delta > 0:
+    yield (context.memcache_incr(PREFIX + up, delta, initial_value=0),
+           context.memcache_incr(name, delta))
+  else:
+    yield (context.memcache_incr(PREFIX + down, -delta, initial_value=0),
+           context.memcache_decr(name, -delta))
+  schedule_flush(name)
+
+
+def schedule_flush(name, delay=None):
+  """Schedule a flush of the buffered changes, once per FLUSH_DELAY window.
+
+  Args:
+    name: The name of the counter.
+    delay: Seconds to wait, defaults to FLUSH_DELAY.
+  """
+  if delay == 0:
+    deferred.defer(flush, name)
+    return
+  defer_once("tailbone-counter-{}".format(name), _config.FLUSH_DELAY, flush, name,
+             _countdown=_config.FLUSH_DELAY if delay is None else delay)
+
+
+def flush(name):
+  """Write the buffered changes of a counter to one shard in a single transaction.
+
+  Args:
+    name: The name of the counter.
+  """
+  ups, downs, delta = _pending(name)
+  if not ups and not downs:
+    return
+  if delta:
+    # the shard is written first, a recount in between may count the changes twice for a while
+    # but never misses them, and a failed write leaves them buffered for the retried task
+    num_shards = _num_shards_async(name).get_result()
+    _change_shard_async(name, num_shards, delta, update_total=False).get_result()
+  up, down = _pending_names(name)
+  # take only what was read, changes buffered meanwhile stay for the next flush
+  memcache.Client().offset_multi({up: -ups, down: -downs}, key_prefix=PREFIX)
+
+
+@ndb.tasklet
+def _change_shard_async(name, num_shards, delta, update_total=True):
+  """Transactional helper to change the value for a given sharded counter.
+
+  Also takes a number of shards to determine which shard will be used. The
+  retries and commit latency of the transaction are recorded for contention.
 
   Args:
     name: The name of the counter.
     num_shards: How many shards to use.
+    delta: Amount to add to the counter, may be negative.
+    update_total: Whether to change the cached total, buffered changes already did.
   """
-  index = random.randint(0, num_shards - 1)
-  shard_key_string = SHARD_KEY_TEMPLATE.format(name, index)
-  counter = TailboneGeneralCounterShard.get_by_id(shard_key_string)
-  if counter is None:
-    counter = TailboneGeneralCounterShard(id=shard_key_string)
-  counter.count += 1
-  counter.put()
+  attempts = []
+
+  @ndb.tasklet
+  def txn():
+    attempts.append(True)
+    index = random.randint(0, num_shards - 1)
+    shard_key_string = SHARD_KEY_TEMPLATE.format(name, index)
+    counter = yield TailboneGeneralCounterShard.get_by_id_async(shard_key_string)
+    if counter is None:
+      counter = TailboneGeneralCounterShard(id=shard_key_string)
+    counter.count += delta
+    yield counter.put_async()
+
+  start = time.time()
+  try:
+    yield ndb.transaction_async(txn)
+  except datastore_errors.TransactionFailedError:
+    failure = sys.exc_info()
+    yield _record_async(name, num_shards, len(attempts), time.time() - start)
+    raise failure[0], failure[1], failure[2]
+  yield _record_async(name, num_shards, len(attempts) - 1, time.time() - start)
+  if not update_total:
+    return
   # Memcache increment does nothing if the name is not a key in memcache
-  memcache.incr(name)
+  if delta > 0:
+    yield ndb.get_context().memcache_incr(name, delta)
+  else:
+    yield ndb.get_context().memcache_decr(name, -delta)
 
 
 @ndb.transactional
@@ -130,4 +482,8 @@ def increase_shards(name, num_shards):
   config = TailboneGeneralCounterShardConfig.get_or_insert(name)
   if config.num_shards < num_shards:
     config.num_shards = num_shards
+    if config.num_read_shards and config.num_read_shards <= num_shards:
+      # growing during a compaction brings every old shard back in use, nothing is left to fold
+      config.num_read_shards = 0
     config.put()
+  _shard_counts.pop(name, None)
@@ -0,0 +1,254 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Bulk import of newline delimited json uploaded through /api/files. A job is split into line
+# aligned byte ranges of the blob, and every range is imported by its own task with put_multi. The
+# search, counter, cache and aggregate work of the put hooks is done once per put_multi instead of
+# once per object.
+
+import json
+
+from tailbone import AppError
+from tailbone import restful
+from tailbone import search
+from tailbone.restful import aggregate
+from tailbone.restful import cache
+from tailbone.restful import counter
+
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+
+# errors kept per chunk, and returned by progress
+CHUNK_ERRORS = 20
+PROGRESS_ERRORS = 100
+
+
+class TailboneImportJob(ndb.Model):
+  """An import of one ndjson blob into a model."""
+  model = ndb.StringProperty(indexed=False)
+  blob = ndb.StringProperty(indexed=False)
+  owner = ndb.KeyProperty(indexed=False)
+  # splitting until the chunk tasks have been queued, then running
+  status = ndb.StringProperty(default="splitting", indexed=False)
+  chunks = ndb.IntegerProperty(default=0, indexed=False)
+  created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+  def to_dict(self, *args, **kwargs):
+    result = super(TailboneImportJob, self).to_dict(*args, **kwargs)
+    result["Id"] = self.key.id()
+    return result
+
+
+class TailboneImportChunk(ndb.Model):
+  """The outcome of one imported byte range, written once the range is done."""
+  job = ndb.IntegerProperty()
+  imported = ndb.IntegerProperty(default=0, indexed=False)
+  failed = ndb.IntegerProperty(default=0, indexed=False)
+  errors = ndb.JsonProperty()
+
+
+def importable_model(model):
+  """The name and class an import writes a model as, like restful.writable_model.
+
+  Raises:
+    AppError: For the users kind and for classes reflective_create can not build.
+  """
+  if model == "users":
+    raise AppError("Users can not be imported.")
+  model, cls = restful.writable_model(model)
+  if not (isinstance(cls, type) and issubclass(cls, ndb.Model)) or cls._get_kind() == "users":
+    raise AppError("{} can not be imported.".format(model))
+  return model, cls
+
+
+def start(model, blob, owner):
+  """Create an import job for a blob and queue the task that splits it.
+
+  Args:
+    model: The lowercase model name of the url, as DEFINED_MODELS is keyed.
+    blob: The blob key of the uploaded ndjson file.
+    owner: The user key set as owner of objects that do not list owners.
+
+  Returns:
+    The TailboneImportJob.
+  """
+  if not blobstore.BlobInfo.get(blob):
+    raise AppError("No uploaded file with key {}.".format(blob))
+  job = TailboneImportJob(model=model, blob=blob, owner=owner)
+  job.put()
+  deferred.defer(split, job.key.id(), _queue=restful._config.IMPORT_QUEUE)
+  return job
+
+
+def split(job_id):
+  """Cut the blob of a job into line aligned ranges and queue a task for each."""
+  job = TailboneImportJob.get_by_id(job_id)
+  size = blobstore.BlobInfo.get(job.blob).size
+  reader = blobstore.BlobReader(job.blob)
+  boundaries = [0]
+  while boundaries[-1] + restful._config.IMPORT_CHUNK_BYTES < size:
+    reader.seek(boundaries[-1] + restful._config.IMPORT_CHUNK_BYTES)
+    # finish the line the cut landed in, the next range starts after it
+    reader.readline()
+    position = reader.tell()
+    if position >= size:
+      break
+    boundaries.append(position)
+  boundaries.append(size)
+  for index in range(len(boundaries) - 1):
+    try:
+      deferred.defer(import_chunk, job_id, index, boundaries[index], boundaries[index + 1],
+                     _queue=restful._config.IMPORT_QUEUE,
+                     _name="tailbone-import-{}-{}".format(job_id, index))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      # queued by an earlier attempt of this task
+      pass
+  job.chunks = len(boundaries) - 1
+  job.status = "running"
+  job.put()
+
+
+def import_chunk(job_id, index, start, end):
+  """Import the lines starting in [start, end) of the blob of a job."""
+  chunk_id = "{}-{}".format(job_id, index)
+  if TailboneImportChunk.get_by_id(chunk_id):
+    return
+  job = TailboneImportJob.get_by_id(job_id)
+  chunk = TailboneImportChunk(id=chunk_id, job=job_id, errors=[])
+  try:
+    model, cls = importable_model(job.model)
+  except AppError as e:
+    # jobs are checked when they start, this only catches a config changed since
+    _fail(chunk, start, e)
+    chunk.put()
+    return
+  reader = blobstore.BlobReader(job.blob)
+  reader.seek(start)
+  pending = []
+  position = start
+  while position < end:
+    line = reader.readline()
+    if not line:
+      break
+    offset = position
+    position += len(line)
+    if not line.strip():
+      continue
+    try:
+      data = json.loads(line)
+      if not isinstance(data, dict):
+        raise AppError("Each line must be a json object.")
+      # a fixed id for lines without one keeps a retried task from creating them twice
+      key = restful.parse_id(None, model, data.get("Id")) or \
+          ndb.Key(model, "import-{}-{}".format(job_id, offset))
+      restful.clean_data(data)
+      restful.validate(cls.__name__, data)
+      m = restful.reflective_create(cls, data)
+      m.key = key
+      if job.owner and hasattr(m, "owners") and not m.owners:
+        m.owners = [job.owner]
+      pending.append((offset, m))
+    except (AppError, ValueError) as e:
+      _fail(chunk, offset, e)
+    if len(pending) >= restful._config.IMPORT_PUT_SIZE:
+      _put(cls, pending, chunk)
+      pending = []
+  if pending:
+    _put(cls, pending, chunk)
+  chunk.put()
+
+
+def _fail(chunk, offset, e):
+  chunk.failed += 1
+  if len(chunk.errors) < CHUNK_ERRORS:
+    chunk.errors.append({"byte": offset, "error": e.__class__.__name__, "message": str(e)})
+
+
+def _put(cls, pending, chunk):
+  models = [m for offset, m in pending]
+  for m, previous in zip(models, ndb.get_multi([m.key for m in models])):
+    m._previous = previous
+    m._prefetched = True
+    m._bulk = True
+  written = []
+  for (offset, m), future in zip(pending, ndb.put_multi_async(models)):
+    try:
+      future.get_result()
+      written.append(m)
+    except (datastore_errors.BadArgumentError,
+            datastore_errors.BadRequestError,
+            datastore_errors.BadValueError) as e:
+      _fail(chunk, offset, e)
+  if written:
+    _after_put(cls, written)
+  chunk.imported += len(written)
+
+
+# The work HookedModel._post_put_hook does for one object, done once for a list of them.
+def _after_put(cls, models):
+  config = restful._config
+  kind = models[0].key.kind()
+  futures = []
+  created = len([m for m in models if m._previous is None])
+  if config.METADATA and created:
+    futures.append(counter.add_async(cls.__name__, created))
+  specs = config.AGGREGATES.get(kind.lower())
+  if specs:
+    futures.append(aggregate.update_many_async(kind.lower(), specs,
+                                               [(m._previous, m) for m in models]))
+  rpcs = []
+  if config.CACHE:
+    rpcs.append(cache.invalidate_async([m.key for m in models]))
+  if config.QUERY_CACHE:
+    rpcs.append(cache.bump_generation_async(kind))
+  search.put_multi(models)
+  if config.post_put_hook:
+    for m in models:
+      config.post_put_hook(m)
+  for future in futures:
+    if future:
+      future.get_result()
+  for rpc in rpcs:
+    rpc.get_result()
+
+
+def progress(job_id):
+  """The state of an import job with the totals of its finished chunks.
+
+  Args:
+    job_id: The Id of the TailboneImportJob.
+
+  Returns:
+    A dict with the job, "chunks_done", "imported", "failed" and the first
+      errors, each with the byte offset of its line.
+  """
+  try:
+    job = TailboneImportJob.get_by_id(int(job_id))
+  except ValueError:
+    job = None
+  if job is None:
+    raise AppError("No import job {}.".format(job_id))
+  result = job.to_dict()
+  chunks = TailboneImportChunk.query(TailboneImportChunk.job == job.key.id()).fetch()
+  result["chunks_done"] = len(chunks)
+  result["imported"] = sum(c.imported for c in chunks)
+  result["failed"] = sum(c.failed for c in chunks)
+  result["errors"] = [e for c in chunks for e in c.errors or []][:PROGRESS_ERRORS]
+  if job.status == "running" and len(chunks) >= job.chunks:
+    result["status"] = "done"
+  return result
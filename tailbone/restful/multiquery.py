@@ -0,0 +1,172 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import heapq
+import json
+
+from tailbone import AppError
+
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import ndb
+
+
+# composite cursors start with this so they are never mistaken for a datastore cursor
+CURSOR_PREFIX = "~"
+# position of a branch that has returned all of its results
+DONE = ""
+DESCENDING = datastore_query.PropertyOrder.DESCENDING
+
+
+def is_composite_cursor(cursor):
+  return bool(cursor) and cursor.startswith(CURSOR_PREFIX)
+
+
+def applies(q):
+  """Whether the filters of a query are an OR of branches this module can run."""
+  return isinstance(q.filters, ndb.query.DisjunctionNode)
+
+
+def _encode(positions):
+  return CURSOR_PREFIX + base64.urlsafe_b64encode(json.dumps(positions))
+
+
+def _decode(cursor, count):
+  if not cursor:
+    return [None] * count
+  try:
+    positions = json.loads(base64.urlsafe_b64decode(str(cursor[len(CURSOR_PREFIX):])))
+  except (TypeError, ValueError):
+    raise AppError("Invalid cursor.")
+  if not isinstance(positions, list) or len(positions) != count:
+    raise AppError("Cursor does not belong to this query.")
+  return positions
+
+
+def _with_cursor(batch, index, entity):
+  return entity, batch.cursor(index + 1)
+
+
+def _property_values(entity, name):
+  """The values of a property, following dotted names into structured properties and flattening
+  repeated ones."""
+  values = [entity]
+  for part in name.split("."):
+    found = []
+    for value in values:
+      value = getattr(value, part, None)
+      if isinstance(value, list):
+        found.extend(v for v in value if v is not None)
+      elif value is not None:
+        found.append(value)
+    values = found
+  return values
+
+
+def _order_value(entity, name, direction):
+  """The value an entity sorts by, like the datastore a repeated property sorts by its smallest
+  value ascending and its largest value descending."""
+  values = _property_values(entity, name)
+  if not values:
+    return None
+  return max(values) if direction == DESCENDING else min(values)
+
+
+class _Head(object):
+  """The next unmerged result of a branch, ordered like the query."""
+
+  def __init__(self, orderings, branch, index, entity):
+    self.branch = branch
+    self.index = index
+    self.key = entity.key if isinstance(entity, ndb.Model) else entity
+    values = []
+    for name, direction in orderings:
+      if name == "__key__":
+        value = self.key.pairs()
+      else:
+        value = _order_value(entity, name, direction)
+      values.append((value, direction))
+    self.values = values
+
+  def __lt__(self, other):
+    for (mine, direction), (theirs, unused) in zip(self.values, other.values):
+      c = cmp(mine, theirs)
+      if c:
+        return c > 0 if direction == DESCENDING else c < 0
+    return cmp(self.key.pairs(), other.key.pairs()) < 0
+
+
+def fetch_page(q, page_size, cursor=None, **options):
+  """Run every branch of an OR query in parallel and merge one page of results.
+
+  Args:
+    q: An ndb.Query whose filters are a DisjunctionNode.
+    page_size: The number of results to return.
+    cursor: A composite cursor from a previous page, or None.
+    **options: Extra query options such as projection.
+
+  Returns:
+    A tuple of the results, the composite cursor after them and whether more
+      results may follow.
+  """
+  orderings = ndb.query._orders_to_orderings(q.orders) if q.orders else []
+  nodes = list(q.filters)
+  positions = _decode(cursor, len(nodes))
+  futures = []
+  for node, position in zip(nodes, positions):
+    if position == DONE:
+      futures.append(None)
+      continue
+    branch = ndb.Query(kind=q.kind, ancestor=q.ancestor, filters=node, orders=q.orders,
+                       app=q.app, namespace=q.namespace, default_options=q.default_options,
+                       projection=q.projection, group_by=q.group_by)
+    start = ndb.Cursor(urlsafe=position) if position else None
+    # one extra result tells whether the branch has more after this page
+    futures.append(branch.map_async(_with_cursor, limit=page_size + 1, batch_size=page_size + 1,
+                                    start_cursor=start, produce_cursors=True,
+                                    pass_batch_into_callback=True, **options))
+
+  fetched = []
+  heap = []
+  for branch, future in enumerate(futures):
+    results = future.get_result() if future else []
+    fetched.append(results)
+    if results:
+      heap.append(_Head(orderings, branch, 0, results[0][0]))
+  heapq.heapify(heap)
+
+  page = []
+  seen = set()
+  while heap:
+    # once the page is full keep going only to skip copies of results already on it
+    if len(page) == page_size and heap[0].key not in seen:
+      break
+    head = heapq.heappop(heap)
+    entity, position = fetched[head.branch][head.index]
+    positions[head.branch] = position.urlsafe()
+    if head.key not in seen:
+      seen.add(head.key)
+      page.append(entity)
+    following = head.index + 1
+    if following < len(fetched[head.branch]):
+      heapq.heappush(heap, _Head(orderings, head.branch, following,
+                                 fetched[head.branch][following][0]))
+    elif len(fetched[head.branch]) <= page_size:
+      positions[head.branch] = DONE
+
+  for branch, future in enumerate(futures):
+    if future and not fetched[branch]:
+      positions[branch] = DONE
+  more = any(position != DONE for position in positions)
+  return page, _encode(positions), more
@@ -0,0 +1,241 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+
+from tailbone import AppError
+from tailbone import defer_once
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import ndb
+
+
+INEQUALITIES = frozenset(["<", "<=", ">", ">="])
+ASCENDING = datastore_query.PropertyOrder.ASCENDING
+DESCENDING = datastore_query.PropertyOrder.DESCENDING
+KEY = "__key__"
+# seconds between writes of the same recorded index
+RECORD_PERIOD = 24 * 60 * 60
+
+
+class TailboneQueryIndex(ndb.Model):
+  """A composite index a query asked for, as an index.yaml entry."""
+  kind = ndb.StringProperty()
+  yaml = ndb.TextProperty()
+  seen = ndb.DateTimeProperty(auto_now=True)
+
+
+# index.yaml entries this process already recorded
+_recorded = set()
+
+
+def _filter_parts(node):
+  return node._FilterNode__name, node._FilterNode__opsymbol, node._FilterNode__value
+
+
+def _node_id(node):
+  if isinstance(node, ndb.query.FilterNode):
+    name, op, value = _filter_parts(node)
+    return (name, op, repr(value))
+  return (repr(node),)
+
+
+def _dnf(node):
+  """The filters of a query as a list of subqueries, each a list of filter nodes."""
+  if node is None:
+    return [[]]
+  if isinstance(node, ndb.query.DisjunctionNode):
+    return [conj for child in node for conj in _dnf(child)]
+  if isinstance(node, ndb.query.ConjunctionNode):
+    result = [[]]
+    for child in node:
+      result = [left + right for left in result for right in _dnf(child)]
+    return result
+  return [[node]]
+
+
+def _minimal(subqueries):
+  """Drop repeated filters and the subqueries whose results another subquery already returns."""
+  unique = []
+  for conj in subqueries:
+    filters = {}
+    for node in conj:
+      filters.setdefault(_node_id(node), node)
+    unique.append(filters)
+  unique.sort(key=len)
+  kept = []
+  for filters in unique:
+    ids = set(filters)
+    # a subquery with a superset of the filters of a kept one only returns a subset of its results
+    if not [k for k in kept if set(k) <= ids]:
+      kept.append(filters)
+  return [[filters[i] for i in sorted(filters)] for filters in kept]
+
+
+def _orderings(q):
+  if not q.orders:
+    return []
+  return ndb.query._orders_to_orderings(q.orders)
+
+
+def _build_orders(orderings):
+  if not orderings:
+    return None
+  orders = [datastore_query.PropertyOrder(name, direction) for name, direction in orderings]
+  return orders[0] if len(orders) == 1 else datastore_query.CompositeOrder(orders)
+
+
+def plan(q, projection=None, max_subqueries=30, parallel=False):
+  """Normalize a query and reject the shapes the datastore can not serve.
+
+  The filters are rewritten as the smallest list of subqueries, the sort
+  orders the datastore requires are added and the composite index the query
+  needs, if any, is recorded.
+
+  Args:
+    q: The ndb.Query built from the request.
+    projection: The list of projected property names, or None.
+    max_subqueries: The most subqueries an OR or IN filter may fan out into.
+    parallel: Whether the subqueries are run and merged by multiquery.fetch_page instead of
+      ndb, which needs no key order to page them.
+
+  Returns:
+    An equivalent ndb.Query.
+
+  Raises:
+    AppError: If the query can not run.
+  """
+  subqueries = _minimal(_dnf(q.filters))
+  if len(subqueries) > max_subqueries:
+    raise AppError("Query needs {} subqueries, at most {} are supported.".format(
+        len(subqueries), max_subqueries))
+
+  inequalities = set()
+  equalities = set()
+  for conj in subqueries:
+    # the datastore allows one inequality property per subquery, each can have its own
+    names = set()
+    for node in conj:
+      if isinstance(node, ndb.query.FilterNode):
+        name, op, value = _filter_parts(node)
+        if op in INEQUALITIES:
+          names.add(name)
+        elif op == "=":
+          equalities.add(name)
+    if len(names) > 1:
+      raise AppError("Inequality filters on more than one property: {}.".format(
+          ", ".join(sorted(names))))
+    inequalities |= names
+  if projection:
+    projected = [p for p in projection if p in equalities]
+    if projected:
+      raise AppError("Can not project properties used in an equality filter: {}.".format(
+          ", ".join(projected)))
+
+  orderings = []
+  for name, direction in _orderings(q):
+    # a sort on a property fixed by an equality filter in every subquery changes nothing
+    if name in equalities and name not in inequalities and len(subqueries) == 1:
+      continue
+    if name not in [n for n, d in orderings]:
+      orderings.append((name, direction))
+  # subqueries merged by ndb or by a requested sort must all be sorted the same way, unsorted
+  # parallel ones are each sorted by their own inequality
+  merged = len(subqueries) > 1 and bool(orderings or not parallel)
+  if inequalities and (merged or len(subqueries) == 1):
+    if len(inequalities) > 1:
+      raise AppError("Subqueries with inequality filters on different properties can not be "
+                     "sorted together: {}.".format(", ".join(sorted(inequalities))))
+    inequality = list(inequalities)[0]
+    if not orderings or orderings[0][0] != inequality:
+      # the datastore sorts by the inequality property first, keep its direction if one was asked
+      direction = dict(orderings).get(inequality, ASCENDING)
+      orderings = [(inequality, direction)] + [o for o in orderings if o[0] != inequality]
+  if len(subqueries) > 1 and not parallel and KEY not in [n for n, d in orderings]:
+    # subqueries merged by ndb need a key order to produce cursors
+    orderings.append((KEY, ASCENDING))
+
+  filters = [ndb.AND(*conj) if len(conj) > 1 else conj[0] for conj in subqueries if conj]
+  if not filters:
+    filters = None
+  elif len(filters) == 1:
+    filters = filters[0]
+  else:
+    filters = ndb.OR(*filters)
+  planned = ndb.Query(kind=q.kind, ancestor=q.ancestor, filters=filters,
+                      orders=_build_orders(orderings), app=q.app, namespace=q.namespace,
+                      default_options=q.default_options, projection=q.projection,
+                      group_by=q.group_by)
+  for conj in subqueries:
+    _record(q.kind, index_yaml(q.kind, q.ancestor is not None, conj, orderings, projection))
+  return planned
+
+
+def index_yaml(kind, ancestor, conj, orderings, projection=None):
+  """The index.yaml entry a subquery needs, or None when the built-in indexes serve it."""
+  equalities = []
+  inequality = None
+  for node in conj:
+    if isinstance(node, ndb.query.FilterNode):
+      name, op, value = _filter_parts(node)
+      if op == "=" and name not in equalities:
+        equalities.append(name)
+      elif op in INEQUALITIES:
+        inequality = name
+  ordered = [(n, d) for n, d in orderings if not (n == KEY and d == ASCENDING)]
+  if inequality and not ordered:
+    ordered = [(inequality, ASCENDING)]
+  sorted_names = [n for n, d in ordered]
+  properties = [(n, ASCENDING) for n in sorted(equalities) if n not in sorted_names] + ordered
+  names = [n for n, d in properties]
+  properties += [(p, ASCENDING) for p in sorted(projection or []) if p not in names]
+  # equality only queries are merged from the single property indexes
+  if not ordered and not projection:
+    return None
+  if len(properties) < 2 and not (ancestor and properties):
+    return None
+  lines = ["- kind: {}".format(kind)]
+  if ancestor:
+    lines.append("  ancestor: yes")
+  lines.append("  properties:")
+  for name, direction in properties:
+    lines.append("  - name: {}".format(name))
+    if direction == DESCENDING:
+      lines.append("    direction: desc")
+  return "\n".join(lines) + "\n"
+
+
+def _record(kind, yaml):
+  if not yaml or yaml in _recorded:
+    return
+  _recorded.add(yaml)
+  logging.info("Query needs a composite index, index.yaml entry:\n%s", yaml)
+  digest = hashlib.sha1(yaml).hexdigest()
+  # stored from a task so a new query shape does not wait on a datastore write
+  try:
+    defer_once("tailbone-index-" + digest, RECORD_PERIOD, _store, digest, kind, yaml)
+  except taskqueue.Error:
+    logging.exception("Could not record the index for %s", kind)
+    _recorded.discard(yaml)
+
+
+def _store(digest, kind, yaml):
+  TailboneQueryIndex(id=digest, kind=kind, yaml=yaml).put()
+
+
+def suggested_indexes(kind):
+  """The index.yaml entries recorded for the queries of a kind."""
+  return "".join(i.yaml for i in TailboneQueryIndex.query(TailboneQueryIndex.kind == kind))
@@ -26,54 +26,195 @@ import urllib
 import webapp2
 import yaml
 
+from google.appengine.api import datastore
+from google.appengine.api import lib_config
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 _INDEX_NAME = "default"
 
+
+class _ConfigDefaults(object):
+  # pull queue holding the keys of kinds indexed with "_mode": "async" in searchable.json
+  QUEUE = "tailbone-search"
+  # seconds to wait before flushing so repeated writes to the same key coalesce
+  FLUSH_DELAY = 5
+  # documents per Index.put call, 200 is the most the search api accepts
+  BATCH_SIZE = 200
+  # seconds a flush holds its leased keys before they are retried
+  LEASE_SECONDS = 60
+
+_config = lib_config.register('tailboneSearch', _ConfigDefaults.__dict__)
+
+
 def put(model):
-  if _searchable:
+  wait(put_async(model))
+
+# Starts indexing the model and returns the search future, or None if the kind is not searchable.
+# Kinds with "_mode": "async" are queued and written in batches by flush instead.
+def put_async(model):
+  searchable = _searchable.get()
+  if searchable:
     kind = model.key.kind()
-    m = _searchable.get(kind)
+    m = searchable.get(kind)
+    if not m:
+      return None
+    if m.get("_mode") == "async":
+      return queue_async(model.key, m)
+    index_name = m.get("_index", _INDEX_NAME)
+    index = search.Index(name=index_name)
+    doc = to_document(model.key, lambda k: getattr(model, k, None), m)
+    return index.put_async(doc)
+  return None
+
+# Index a list of models with one Index.put per BATCH_SIZE documents, or one queue add per 100 keys
+# for kinds with "_mode": "async".
+def put_multi(models):
+  searchable = _searchable.get()
+  if not searchable:
+    return
+  docs = {}
+  tasks = {}
+  for model in models:
+    m = searchable.get(model.key.kind())
     if not m:
-      return
+      continue
     index_name = m.get("_index", _INDEX_NAME)
+    if m.get("_mode") == "async":
+      tasks.setdefault(index_name, []).append(
+          taskqueue.Task(payload=model.key.urlsafe(), method="PULL", tag=index_name))
+    else:
+      docs.setdefault(index_name, []).append(
+          to_document(model.key, lambda k, model=model: getattr(model, k, None), m))
+  for index_name, batch in docs.iteritems():
     index = search.Index(name=index_name)
-    fields = []
-    for k, v in m.iteritems():
-      # skip things starting with _ like _index
-      if k[0] == "_":
-        continue
-      cls = getattr(search, v)
-      search_val = getattr(model, k, None)
-      if not search_val:
-        continue
-      # Note: GeoPt values should be converted tp search.GeoPoint values before adding to the search index !
-      if isinstance(search_val, ndb.GeoPt):
-         search_val = search.GeoPoint(search_val.lat, search_val.lon)
-      fields.append(cls(name=k, value=search_val))
-    # add a Kind type to all searchable items in the default index
-    if index_name == _INDEX_NAME:
-      fields.append(search.TextField(name="Kind", value=kind))
-    doc = search.Document(doc_id=model.key.urlsafe(), fields=fields)
+    for i in range(0, len(batch), _config.BATCH_SIZE):
+      try:
+        index.put(batch[i:i + _config.BATCH_SIZE])
+      except search.Error:
+        logging.exception("Could not index a batch of %s documents.", index_name)
+  for index_name, batch in tasks.iteritems():
+    queue = taskqueue.Queue(_config.QUEUE)
     try:
-      index.put(doc)
-    except search.Error:
-      logging.error("Failed to put document {}".format(doc))
+      for i in range(0, len(batch), 100):
+        queue.add(batch[i:i + 100])
+      schedule_flush(index_name)
+    except taskqueue.Error:
+      logging.exception("Could not queue a batch of %s keys for indexing.", index_name)
+
+# Build the search document for a key given a getter for its property values.
+def to_document(key, get, m):
+  kind = key.kind()
+  index_name = m.get("_index", _INDEX_NAME)
+  fields = []
+  for k, v in m.iteritems():
+    # skip things starting with _ like _index
+    if k[0] == "_":
+      continue
+    cls = getattr(search, v)
+    search_val = get(k)
+    if not search_val:
+      continue
+    # Note: GeoPt values should be converted tp search.GeoPoint values before adding to the search index !
+    if isinstance(search_val, ndb.GeoPt):
+       search_val = search.GeoPoint(search_val.lat, search_val.lon)
+    fields.append(cls(name=k, value=search_val))
+  # add a Kind type to all searchable items in the default index
+  if index_name == _INDEX_NAME:
+    fields.append(search.TextField(name="Kind", value=kind))
+  return search.Document(doc_id=key.urlsafe(), fields=fields)
 
 def delete(key):
-  if _searchable:
+  wait(delete_async(key))
+
+# Starts removing the key from its index and returns the search future, or None if the kind is not
+# searchable.
+def delete_async(key):
+  searchable = _searchable.get()
+  if searchable:
     kind = key.kind()
-    m = _searchable.get(kind)
+    m = searchable.get(kind)
     if not m:
-      return
+      return None
+    if m.get("_mode") == "async":
+      return queue_async(key, m)
     index_name = m.get("_index", _INDEX_NAME)
     index = search.Index(name=index_name)
-    try:
-      index.delete(key.urlsafe())
-    except search.DeleteError as e:
-      logging.error("Failed to delete document {}: {}".format(key, e))
+    return index.delete_async(key.urlsafe())
+  return None
+
+
+# Asynchronous indexing
+# ---------------------
+# Writes only add the key to a pull queue tagged with the index name. A flush task, scheduled at
+# most once per FLUSH_DELAY window, leases up to BATCH_SIZE keys, reads their current state and
+# updates the index with one put and one delete. Repeated writes to a key in a window become one
+# document. If the index update fails the keys stay leased, so another flush is scheduled for when
+# the lease expires.
+def queue_async(key, m):
+  index_name = m.get("_index", _INDEX_NAME)
+  task = taskqueue.Task(payload=key.urlsafe(), method="PULL", tag=index_name)
+  rpc = taskqueue.Queue(_config.QUEUE).add_async(task)
+  try:
+    schedule_flush(index_name)
+  except taskqueue.Error as e:
+    # a later write schedules the flush that picks this key up
+    logging.error("Failed to schedule a search flush: {}".format(e))
+  return rpc
+
+def schedule_flush(index_name, delay=None):
+  if delay == 0:
+    deferred.defer(flush, index_name)
+    return
+  defer_once("tailbone-search-{}".format(index_name), _config.FLUSH_DELAY, flush, index_name,
+             _countdown=_config.FLUSH_DELAY if delay is None else delay)
+
+def flush(index_name):
+  queue = taskqueue.Queue(_config.QUEUE)
+  tasks = queue.lease_tasks_by_tag(_config.LEASE_SECONDS, _config.BATCH_SIZE, tag=index_name)
+  if not tasks:
+    return
+  keys = [ndb.Key(urlsafe=urlsafe) for urlsafe in set(t.payload for t in tasks)]
+  # read raw entities so no model class needs to be registered for the kind
+  entities = datastore.Get([key.to_old_key() for key in keys])
+  searchable = _searchable.get() or {}
+  docs = []
+  removed = []
+  for key, entity in zip(keys, entities):
+    m = searchable.get(key.kind())
+    if entity is None or not m:
+      removed.append(key.urlsafe())
+    else:
+      docs.append(to_document(key, entity.get, m))
+  index = search.Index(name=index_name)
+  try:
+    if docs:
+      index.put(docs)
+    if removed:
+      index.delete(removed)
+  except search.Error as e:
+    logging.error("Failed to flush search index {}, retrying: {}".format(index_name, e))
+    # a retry before the lease runs out would find nothing to lease
+    deferred.defer(flush, index_name, _countdown=_config.LEASE_SECONDS + 1)
+    return
+  queue.delete_tasks(tasks)
+  if len(tasks) == _config.BATCH_SIZE:
+    # more keys are probably waiting
+    schedule_flush(index_name, delay=0)
+
+# Wait for a future from put_async or delete_async, failures are logged rather than raised so a
+# broken index or a full queue never fails the datastore write.
+def wait(future):
+  if future is None:
+    return
+  try:
+    future.get_result()
+  except search.Error as e:
+    logging.error("Failed to update search index: {}".format(e))
+  except taskqueue.Error as e:
+    logging.error("Failed to queue search index update: {}".format(e))
 
 
 def doc_to_json(doc):
@@ -135,14 +276,8 @@ def compile_searchable(target):
       target[k] = compile_searchable(v)
   return target
 
-_searchable = None
-try:
-  with open("searchable.json") as f:
-    _searchable = compile_searchable(json.load(f))
-except ValueError:
-  logging.error("searchable.json is not a valid json document.")
-except IOError:
-  logging.info("searchable.json doesn't exist nothing can be searched.")
+_searchable = ReloadableConfig("searchable.json", compile_searchable,
+                               "searchable.json doesn't exist nothing can be searched.")
 
 app = webapp2.WSGIApplication([
   (r"{}search/?(.*)".format(PREFIX), SearchHandler),